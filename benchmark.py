@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+
+# Documentation: See https://github.com/jjermann/dicedensity
+
+# Benchmarks for the hot paths of densities.py and combatant.py, e.g.:
+#   ./benchmark.py --output before.json
+#   ./benchmark.py --output after.json
+#   ./benchmark.py --compare before.json after.json
+
+from densities import *
+from combatant import *
+import argparse
+import json
+import platform
+import re
+import statistics
+import sys
+import time
+import tracemalloc
+
+
+# Fixtures (combatants from main.py and test.py), created freshly for every run such that no cached results are reused
+def dnd2NealCombatants():
+  dnd2NealCombatant1 = Dnd2NealCombatant(hp=20, attackDie=AdvantageDie(20), bonusToHit=9, damageDie=Die(8)+Die(4), bonusToDamage=3, ac=13)
+  dnd2NealCombatant2 = Dnd2NealCombatant(hp=20, attackDie=Die(20), bonusToHit=9, damageDie=Die(8), bonusToDamage=3, ac=18)
+  return (dnd2NealCombatant1, dnd2NealCombatant2)
+
+def combatants():
+  combatant1 = Combatant(hp=20, maxFatigue=10, attackDie=AdvantageDie(20), bonusToHit=3, damageDie=Die(4), bonusToDamage=2, evade=2, armor=5, resistance=0)
+  combatant2 = Combatant(hp=20, maxFatigue=10, attackDie=Die(20), bonusToHit=1, damageDie=Die(8), bonusToDamage=-1, evade=5, armor=10, resistance=6)
+  return (combatant1, combatant2)
+
+def testCombatants():
+  ogreBro = DndNealTestCombatant(hp=100, bonusToHit=0, bonusToHitUnarmored=0, damageDie=Die(10)+Die(10), bonusToDamage=0, evade=20, criticalThreshold=30, armor=0, maxFatigue=None)
+  warrior = DndNealTestCombatant(hp=50, bonusToHit=31, bonusToHitUnarmored=31, damageDie=Die(6)+Die(6), bonusToDamage=0, evade=49, criticalThreshold=32, armor=0, maxFatigue=None)
+  return (ogreBro, warrior)
+
+
+# Each benchmark is a setup function which returns the function to measure
+def _convolveSum(n, die):
+  # additions of integer densities are convolutions (see Density._convolve)
+  def setup():
+    a = Die(die).arithMult(n)
+    b = Die(die).arithMult(n)
+    return lambda: a + b
+  return setup
+
+def _binOpSum(n, die):
+  # the generic dictionary path, as used for float or tuple outcomes and other operators
+  def setup():
+    a = Die(die).arithMult(n)
+    b = Die(die).arithMult(n)
+    return lambda: a.binOp(b, lambda x, y: x + y)
+  return setup
+
+def _arithMult(die, n):
+  def setup():
+    d = Die(die)
+    return lambda: d.arithMult(n)
+  return setup
+
+def _comparison():
+  a = Die(20).arithMult(5) + 7
+  b = Die(20).arithMult(5) + 5
+  return lambda: (a >= b, a < b, a == b, a.prob(b, lambda x, y: x > y))
+
+def _cdfMedian():
+  d = Die(10).arithMult(30)
+  return lambda: ([d.cdf(x) for x in range(30, 301, 5)], d.median())
+
+def _keepHighest():
+  m = MultiDensity(Die(20), Die(20), Die(20), Die(20))
+  return lambda: m.keep_highest(2)
+
+def _dropLowest():
+  m = MultiDensity(Die(6), Die(6), Die(6), Die(6))
+  return lambda: m.drop_lowest()
+
+def _summedDensity():
+  d = Die(6) + Die(6)
+  return lambda: d.summedDensity(50)
+
+def _dieExprParsing():
+  return lambda: [DieExpr(expr) for expr in ["d20 + 3*d6 + d8 - 2 >= 15", "ad20 + 5 > d20 + 7", "d6 + d6 + d6 + d8 + 3", "p10d10s8 >= 3"]]
+
+def _winProbability(fixture, **kwargs):
+  def setup():
+    attacker, defender = fixture()
+    return lambda: attacker.winProbability(defender, **kwargs)
+  return setup
+
+def _hpDensity(fixture, **kwargs):
+  def setup():
+    attacker, defender = fixture()
+    return lambda: attacker.hpDensity(defender, **kwargs)
+  return setup
+
+benchmarks = [
+  ("convolve/m10d6+m10d6", _convolveSum(10, 6)),
+  ("convolve/m10d20+m10d20", _convolveSum(10, 20)),
+  ("convolve/m10d100+m10d100", _convolveSum(10, 100)),
+  ("binOp/m10d6+m10d6", _binOpSum(10, 6)),
+  ("binOp/m10d20+m10d20", _binOpSum(10, 20)),
+  ("arithMult/d6*100", _arithMult(6, 100)),
+  ("arithMult/d20*50", _arithMult(20, 50)),
+  ("comparison/m5d20", _comparison),
+  ("cdfMedian/m30d10", _cdfMedian),
+  ("multiDensity/keep_highest", _keepHighest),
+  ("multiDensity/drop_lowest", _dropLowest),
+  ("summedDensity/2d6", _summedDensity),
+  ("dieExpr/parse", _dieExprParsing),
+  ("combat/winProbability/precise", _winProbability(dnd2NealCombatants, chanceDefenderStarts=0.5)),
+  ("combat/winProbability/expected", _winProbability(combatants, precise=False, maxError=0.001)),
+  ("combat/winProbability/simple", _winProbability(testCombatants, chanceDefenderStarts=0.5, precise=False, simple=True, maxError=0.01)),
+  ("combat/hpDensity/precise", _hpDensity(combatants, rounds=3)),
+  ("combat/hpDensity/expected", _hpDensity(combatants, rounds=10, precise=False)),
+  ("combat/hpDensity/simple", _hpDensity(testCombatants, rounds=10, precise=False, simple=True)),
+]
+
+
+def _timeLoops(setup, loops):
+  # every loop gets fresh objects from setup (otherwise the cached results would be measured), only the calls are timed
+  total = 0.0
+  for i in range(loops):
+    f = setup()
+    start = time.perf_counter()
+    f()
+    total += time.perf_counter() - start
+  return total
+
+def _calibrateLoops(setup, minTime):
+  # like timeit.Timer.autorange: the smallest number of loops 1, 2, 5, 10, 20, 50, ... taking at least minTime seconds
+  i = 1
+  while True:
+    for loops in (i, 2*i, 5*i):
+      if _timeLoops(setup, loops) >= minTime:
+        return loops
+    i *= 10
+
+def runBenchmark(setup, repeat, minTime = 0.2):
+  loops = _calibrateLoops(setup, minTime)
+  times = [ _timeLoops(setup, loops)/loops for i in range(repeat) ]
+  # peak memory is measured in a separate run (tracemalloc slows down the calculation)
+  f = setup()
+  tracemalloc.start()
+  f()
+  peakMemory = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return {"min": min(times), "median": statistics.median(times), "repeat": repeat, "loops": loops, "peakMemory": peakMemory}
+
+def runBenchmarks(pattern = None, repeat = 3, verbose = True, minTime = 0.2):
+  results = {}
+  for name, setup in benchmarks:
+    if not pattern is None and re.search(pattern, name) is None:
+      continue
+    results[name] = runBenchmark(setup, repeat, minTime)
+    if verbose:
+      print("{:<40} {:>12.6f}s {:>12.6f}s {:>12.1f}KiB".format(name, results[name]["min"], results[name]["median"], results[name]["peakMemory"]/1024.0), file=sys.stderr)
+  return {
+    "python": platform.python_version(),
+    "numpy": np.__version__,
+    "platform": platform.platform(),
+    "results": results
+  }
+
+def compareRuns(before, after, threshold = 0.1):
+  # Returns a text table with the relative changes, changes above threshold are marked
+  res = "{:<40} {:>12} {:>12} {:>9} {:>9}".format("Benchmark", "Before", "After", "Time", "Memory") + "\n"
+  for name in before["results"]:
+    if not name in after["results"]:
+      continue
+    b = before["results"][name]
+    a = after["results"][name]
+    timeRatio = a["min"]/b["min"] if b["min"] > 0 else float("inf")
+    memoryRatio = a["peakMemory"]/b["peakMemory"] if b["peakMemory"] > 0 else float("inf")
+    mark = ""
+    if timeRatio > 1 + threshold or memoryRatio > 1 + threshold:
+      mark = " (regression)"
+    elif timeRatio < 1 - threshold:
+      mark = " (improvement)"
+    res += "{:<40} {:>11.6f}s {:>11.6f}s {:>8.2f}x {:>8.2f}x{}".format(name, b["min"], a["min"], timeRatio, memoryRatio, mark) + "\n"
+  return res
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmarks for densities.py and combatant.py")
+  parser.add_argument("--filter", help="only run benchmarks whose name matches the regular expression")
+  parser.add_argument("--repeat", type=int, default=3, help="number of timed runs per benchmark (the minimum and median time per loop are reported)")
+  parser.add_argument("--min-time", type=float, default=0.2, help="minimal duration of a timed run in seconds (the number of loops is calibrated accordingly)")
+  parser.add_argument("--output", help="write the results as JSON to the given file (default: stdout)")
+  parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two JSON result files")
+  parser.add_argument("--threshold", type=float, default=0.1, help="relative change which is reported as regression/improvement")
+  parser.add_argument("--list", action="store_true", help="list the available benchmarks")
+  args = parser.parse_args()
+
+  if args.list:
+    for name, setup in benchmarks:
+      print(name)
+  elif args.compare:
+    with open(args.compare[0]) as f:
+      before = json.load(f)
+    with open(args.compare[1]) as f:
+      after = json.load(f)
+    print(compareRuns(before, after, args.threshold), end="")
+  else:
+    results = runBenchmarks(args.filter, args.repeat, minTime = args.min_time)
+    if args.output is None:
+      print(json.dumps(results, indent=2))
+    else:
+      with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
@@ -1,4 +1,16 @@
 from densities import *
+from collections import ChainMap
+import json
+import time
+
+# Declares the combatant fields a damage density depends on (used to cache derived results, see CombatantProfile).
+# The pseudo field "fatigueState" stands for the fatigue state (resp. fatigueModifier) of the combatant.
+def dependsOn(attacker = (), defender = ()):
+  def decorator(damageDensity):
+    damageDensity.attackerFields = tuple(attacker)
+    damageDensity.defenderFields = tuple(defender)
+    return damageDensity
+  return decorator
 
 class Combatant:
   def __init__(self, hp, attackDie, bonusToHit, damageDie, bonusToDamage, evade, armor = 0, resistance = 0, maxFatigue = None, fatigue = 0, criticalThreshold = 5, damageDensity = None, bonusToHitUnarmored = None):
@@ -48,6 +60,7 @@ class Combatant:
     return Combatant(self.hp, self.attackDie, self.bonusToHit, self.damageDie, self.bonusToDamage, self.evade, self.armor, self.resistance, self.maxFatigue, self.fatigue, self.criticalThreshold, self._damageDensity, self.bonusToHitUnarmored)
 
   @staticmethod
+  @dependsOn(attacker=("bonusToHit", "damageDie", "bonusToDamage", "criticalThreshold", "fatigueState"), defender=("evade", "armor", "resistance"))
   def defaultDamageDensity(attacker, defender, attackRoll):
     if attackRoll + attacker.bonusToHit + attacker.fatigueModifier() < defender.evade:
       return Zero()
@@ -64,6 +77,7 @@ class Combatant:
     return damage
 
   @staticmethod
+  @dependsOn(attacker=("attackDie", "bonusToHit", "damageDie", "bonusToDamage", "criticalThreshold", "fatigueState"), defender=("evade", "armor", "resistance"))
   def dndDamageDensity(attacker, defender, attackRoll):
     minValue = min(attacker.attackDie.values())
     maxValue = max(attacker.attackDie.values())
@@ -134,9 +148,15 @@ class Combatant:
     chance = sum([d[damageDensity]*(1.0 if isHit(damageDensity) else 0.0) for damageDensity in d])
     return chance
 
+  def attackDamageDensity(self, defender, cond=None):
+    d = self.damageDensityDistribution(defender, cond)
+    return mixture(list(d.keys()), list(d.values()))
+
+  def totalDamageDensity(self, defender, attacks=1, cond=None):
+    return self.attackDamageDensity(defender, cond).arithMult(attacks)
+
   def expectedDamage(self, defender, cond=None):
-    d = self.damageDensityDistribution(defender,cond)
-    return sum([d[damageDensity]*damageDensity.expected() for damageDensity in d])
+    return self.attackDamageDensity(defender, cond).expected()
 
   def plotDamage(self, defender):
     res = ""
@@ -147,12 +167,16 @@ class Combatant:
     return res
 
   def plotDamageImage(self, defender):
-    def ExpectedDamage(attackRoll):
-      return self.damageDensity(defender, attackRoll).expected()
+    plot_images([self.plotDamageImageJob(defender)], format = None)
+
+  def plotDamageImageJob(self, defender, name = "ExpectedDamage"):
+    # every damage density is calculated once, the total expected damage is derived from the same values
     inputs = self.attackDie.keys()
-    xlabel = "Attack roll (Total expected damage: {})".format(self.expectedDamage(defender))
+    outputs = [self.damageDensity(defender, k).expected() for k in inputs]
+    expectedDamage = sum([self.attackDie[k]*output for k, output in zip(inputs, outputs)])
+    xlabel = "Attack roll (Total expected damage: {})".format(expectedDamage)
     ylabel = "Expected damage"
-    plot_image(ExpectedDamage, inputs = inputs, xlabel=xlabel, ylabel=ylabel)
+    return PlotJob(name, inputs, outputs, xlabel=xlabel, ylabel=ylabel)
 
   def isDead(self):
     return self.hp <= 0
@@ -205,49 +229,87 @@ class Combatant:
       clone.fatigue += 1
     return clone
 
+  def _quantizedCombatants(self, hpGrid):
+    # Splits the combatant between the two adjacent grid points of its hp such that the expected hp stays the same.
+    # Combatants on the grid (up to rounding errors) are only snapped to it, living combatants below the lowest
+    # positive grid point keep their hp (moving them up would revive them, moving them down would kill them).
+    # Returns the quantized combatants with their weights and whether the combatant was moved.
+    nearest = round(self.hp / hpGrid)*hpGrid
+    if abs(self.hp - nearest) < 1e-9:
+      if nearest == self.hp:
+        return ([(self, 1.0)], False)
+      snappedClone = self.clone()
+      snappedClone.hp = nearest
+      return ([(snappedClone, 1.0)], False)
+    if 0 < self.hp < hpGrid:
+      return ([(self, 1.0)], False)
+    k = math.floor(self.hp / hpGrid)
+    lower = k*hpGrid
+    upper = (k + 1)*hpGrid
+    upperWeight = min(1.0, max(0.0, (self.hp - lower) / hpGrid))
+    lowerClone = self.clone()
+    lowerClone.hp = lower
+    upperClone = self.clone()
+    upperClone.hp = upper
+    return ([(lowerClone, 1.0 - upperWeight), (upperClone, upperWeight)], True)
+
+  @staticmethod
+  def _quantizeDistribution(d, hpGrid):
+    # Returns the quantized distribution and a bound on the change of any probability of the combat result caused by it:
+    # the result probabilities of a state are in [0, 1], so moving the mass of undecided states changes them by at most that mass
+    # (decided states keep their outcome and later rounds don't increase the difference).
+    # The grid is only applied if it reduces the number of states, otherwise the distribution is returned unchanged.
+    dNew = {}
+    error = 0.0
+    for (attacker, defender) in d:
+      pState = d[(attacker, defender)]
+      attackerList, attackerMoved = attacker._quantizedCombatants(hpGrid)
+      defenderList, defenderMoved = defender._quantizedCombatants(hpGrid)
+      if (attackerMoved or defenderMoved) and attacker.canFight() and defender.canFight():
+        error += pState
+      for attackerNew, pAttacker in attackerList:
+        for defenderNew, pDefender in defenderList:
+          try:
+            dNew[(attackerNew, defenderNew)] += pState*pAttacker*pDefender
+          except KeyError:
+            dNew[(attackerNew, defenderNew)] = pState*pAttacker*pDefender
+    if len(dNew) >= len(d):
+      return (d, 0.0)
+    return (dNew, error)
+
+  def _attackTransition(self, defender, precise=True, damageDensityDistribution=None):
+    # Distribution {defenderNew: probability} of the defender after one attack
+    dd = self.damageDensityDistribution(defender) if damageDensityDistribution is None else damageDensityDistribution
+    d = {}
+    for damageDensity in dd:
+      if precise:
+        defenderD = self._attackedCombatantDistribution(defender, damageDensity)
+        for defenderNew in defenderD:
+          try:
+            d[defenderNew] += dd[damageDensity]*defenderD[defenderNew]
+          except KeyError:
+            d[defenderNew] = dd[damageDensity]*defenderD[defenderNew]
+      else:
+        defenderNew = self._expectedAttackedCombatant(defender, damageDensity)
+        try:
+          d[defenderNew] += dd[damageDensity]
+        except KeyError:
+          d[defenderNew] = dd[damageDensity]
+    return d
+
   @staticmethod
   def _adjustedSingleAttackDistribution(state, pState, reversed=False, precise=True, simple=False, attackerDmgDist=None, defenderDmgDist=None):
     dNew = {}
 
     attacker,defender = state
     if reversed:
-      if simple:
-        dd = defenderDmgDist
-      else:
-        dd = defender.damageDensityDistribution(attacker)
-      for damageDensity in dd:
-        if precise:
-          attackerD = defender._attackedCombatantDistribution(attacker, damageDensity)
-          for attackerNew in attackerD:
-            try:
-              dNew[(attackerNew, defender)] += dd[damageDensity]*pState*attackerD[attackerNew]
-            except KeyError:
-              dNew[(attackerNew, defender)] = dd[damageDensity]*pState*attackerD[attackerNew]
-        else:
-          attackerNew = defender._expectedAttackedCombatant(attacker, damageDensity)
-          try:
-            dNew[(attackerNew, defender)] += dd[damageDensity]*pState
-          except KeyError:
-            dNew[(attackerNew, defender)] = dd[damageDensity]*pState
+      attackerD = defender._attackTransition(attacker, precise, defenderDmgDist if simple else None)
+      for attackerNew in attackerD:
+        dNew[(attackerNew, defender)] = pState*attackerD[attackerNew]
     else:
-      if simple:
-        dd = attackerDmgDist
-      else:
-        dd = attacker.damageDensityDistribution(defender)
-      for damageDensity in dd:
-        if precise:
-          defenderD = attacker._attackedCombatantDistribution(defender, damageDensity)
-          for defenderNew in defenderD:
-            try:
-              dNew[(attacker, defenderNew)] += dd[damageDensity]*pState*defenderD[defenderNew]
-            except KeyError:
-              dNew[(attacker, defenderNew)] = dd[damageDensity]*pState*defenderD[defenderNew]
-        else:
-          defenderNew = attacker._expectedAttackedCombatant(defender, damageDensity)
-          try:
-            dNew[(attacker, defenderNew)] += dd[damageDensity]*pState
-          except KeyError:
-            dNew[(attacker, defenderNew)] = dd[damageDensity]*pState
+      defenderD = attacker._attackTransition(defender, precise, attackerDmgDist if simple else None)
+      for defenderNew in defenderD:
+        dNew[(attacker, defenderNew)] = pState*defenderD[defenderNew]
 
     return dNew
 
@@ -272,7 +334,7 @@ class Combatant:
     return dNew2
 
   @staticmethod
-  def combatDistribution(attacker, defender, rounds = 1, chanceDefenderStarts = None, precise=True, simple=False):
+  def combatDistribution(attacker, defender, rounds = 1, chanceDefenderStarts = None, precise=True, simple=False, hpGrid=None, includeError=False):
     if simple:
       attackerDmgDist = attacker.damageDensityDistribution(defender)
       defenderDmgDist = defender.damageDensityDistribution(attacker)
@@ -280,11 +342,21 @@ class Combatant:
       attackerDmgDist = None
       defenderDmgDist = None
     d = {(attacker, defender): 1.0}
+    quantizationError = 0.0
     if not chanceDefenderStarts is None:
       d = Combatant.randomizeInitialAttacker(d, chanceDefenderStarts, precise=precise)
+      if not hpGrid is None:
+        d, error = Combatant._quantizeDistribution(d, hpGrid)
+        quantizationError += error
 
     for round in range(rounds):
       d = Combatant._applyAttackRound(d, precise=precise, simple=simple, attackerDmgDist=attackerDmgDist, defenderDmgDist=defenderDmgDist)
+      if not hpGrid is None:
+        d, error = Combatant._quantizeDistribution(d, hpGrid)
+        quantizationError += error
+
+    if includeError:
+      return (d, quantizationError)
     return d
 
   @staticmethod
@@ -292,27 +364,44 @@ class Combatant:
     return sum([d[(attacker, defender)] for (attacker, defender) in d if cond(attacker, defender)])
 
   @staticmethod
-  def combatEventProbability(attacker, defender, cond, rounds = 1, chanceDefenderStarts = None, precise=True, simple=False):
-    d = Combatant.combatDistribution(attacker, defender, rounds, chanceDefenderStarts, precise=precise, simple=simple)
+  def _evaluateQueries(d, queryList):
+    # All queries are evaluated in a single pass over the distribution
+    accumulators = [ query._start() for query in queryList ]
+    for (attacker, defender) in d:
+      pState = d[(attacker, defender)]
+      for i, query in enumerate(queryList):
+        accumulators[i] = query._add(accumulators[i], attacker, defender, pState)
+    return [ query._result(acc) for query, acc in zip(queryList, accumulators) ]
+
+  @staticmethod
+  def queryDistribution(d, queries):
+    names = list(queries.keys())
+    results = Combatant._evaluateQueries(d, [ queries[name] for name in names ])
+    return dict(zip(names, results))
+
+  @staticmethod
+  def combatQueries(attacker, defender, queries, rounds = 1, chanceDefenderStarts = None, precise=True, simple=False, hpGrid=None):
+    d = Combatant.combatDistribution(attacker, defender, rounds, chanceDefenderStarts, precise=precise, simple=simple, hpGrid=hpGrid)
+    return Combatant.queryDistribution(d, queries)
+
+  @staticmethod
+  def combatEventProbability(attacker, defender, cond, rounds = 1, chanceDefenderStarts = None, precise=True, simple=False, hpGrid=None):
+    d = Combatant.combatDistribution(attacker, defender, rounds, chanceDefenderStarts, precise=precise, simple=simple, hpGrid=hpGrid)
     p = Combatant.eventProbability(d, cond)
     return p
 
   @staticmethod
   def resultDensity(d, op):
-    density = {}
-    keys = set([op(attacker, defender) for (attacker, defender) in d])
-    for k in keys:
-      density[k] = Combatant.eventProbability(d, lambda attacker, defender: k == op(attacker, defender))
-    return Density(density)
+    return Combatant._evaluateQueries(d, [DensityQuery(op)])[0]
 
   @staticmethod
-  def combatResultDensity(attacker, defender, op, rounds = 1, chanceDefenderStarts = None, precise=True, simple=False):
-    d = Combatant.combatDistribution(attacker, defender, rounds, chanceDefenderStarts, precise=precise, simple=simple)
+  def combatResultDensity(attacker, defender, op, rounds = 1, chanceDefenderStarts = None, precise=True, simple=False, hpGrid=None):
+    d = Combatant.combatDistribution(attacker, defender, rounds, chanceDefenderStarts, precise=precise, simple=simple, hpGrid=hpGrid)
     return Combatant.resultDensity(d, op)
 
-  def hpDensity(self, defender, rounds = 1, chanceDefenderStarts = None, precise=True, simple=False):
+  def hpDensity(self, defender, rounds = 1, chanceDefenderStarts = None, precise=True, simple=False, hpGrid=None):
     op = lambda attacker, defender: attacker.hp
-    return Combatant.combatResultDensity(self, defender, op, rounds, chanceDefenderStarts, precise=precise, simple=simple)
+    return Combatant.combatResultDensity(self, defender, op, rounds, chanceDefenderStarts, precise=precise, simple=simple, hpGrid=hpGrid)
 
   @staticmethod
   def randomizeInitialAttacker(d, chanceDefenderStarts = 0.5, precise=True):
@@ -333,32 +422,16 @@ class Combatant:
           dNew[(attacker, defender)] += p
       return dNew
 
-  def winProbability(self, defender, chanceDefenderStarts = None, precise = True, simple = False, maxError = 0.005, includeError = False):
-    if simple:
-      attackerDmgDist = self.damageDensityDistribution(defender)
-      defenderDmgDist = defender.damageDensityDistribution(self)
-    else:
-      attackerDmgDist = None
-      defenderDmgDist = None
-    d = {(self, defender): 1.0}
-    if not chanceDefenderStarts is None:
-      d = Combatant.randomizeInitialAttacker(d, chanceDefenderStarts, precise=precise)
-
-    undecidedCond = lambda attacker, defender: attacker.canFight() and defender.canFight()
-    while Combatant.eventProbability(d, undecidedCond) > maxError:
-      d = Combatant._applyAttackRound(d, precise=precise, simple=simple, attackerDmgDist=attackerDmgDist, defenderDmgDist=defenderDmgDist)
-
-    winCond = lambda attacker, defender: defender.cantFight()
-    p = Combatant.eventProbability(d, winCond)
-    up = Combatant.eventProbability(d, undecidedCond)
-
-    if includeError:
-      return (p + up*p/(1-up), p, up)
+  def solveCombat(self, defender, chanceDefenderStarts = None, precise = True, simple = False, maxError = 0.005, hpGrid = None, roundQueries = None, onRound = None):
+    solution = CombatSolution(self, defender, chanceDefenderStarts = chanceDefenderStarts, precise = precise, simple = simple, hpGrid = hpGrid)
+    return solution.refine(maxError, roundQueries = roundQueries, onRound = onRound)
 
-    return p + up*p/(1-up)
+  def winProbability(self, defender, chanceDefenderStarts = None, precise = True, simple = False, maxError = 0.005, includeError = False, hpGrid = None, roundQueries = None, onRound = None):
+    solution = self.solveCombat(defender, chanceDefenderStarts, precise, simple, maxError, hpGrid, roundQueries, onRound)
+    return solution.winProbability(includeError)
 
-  def simpleWinProbability(self, defender, chanceDefenderStarts = 0.5, precise = False, maxError = 0.001):
-    p = self.winProbability(defender, chanceDefenderStarts = chanceDefenderStarts, precise = precise, simple = True, maxError = maxError)
+  def simpleWinProbability(self, defender, chanceDefenderStarts = 0.5, precise = False, maxError = 0.001, hpGrid = None):
+    p = self.winProbability(defender, chanceDefenderStarts = chanceDefenderStarts, precise = precise, simple = True, maxError = maxError, hpGrid = hpGrid)
     return p
 
 
@@ -369,42 +442,260 @@ class DndCombatant(Combatant):
     Combatant.__init__(self, hp, attackDie, bonusToHit, damageDie, bonusToDamage, ac, damageDensity = damageDensity)
 
 
+# The damage densities of the Neal combatants are picklable callables (needed for worker processes, see sampling.py).
+# Equal parameters give equal damage densities, so cached results are shared between combatants.
+@dependsOn(attacker=("attackDie", "bonusToHit", "damageDie", "bonusToDamage"), defender=("evade",))
+class NealDamageDensity:
+  def __init__(self, minAttack, maxAttack):
+    self.minAttack = minAttack
+    self.maxAttack = maxAttack
+
+  def __call__(self, attacker, defender, attackRoll):
+    if attackRoll == self.minAttack:
+      return Zero()
+    if (attackRoll + attacker.bonusToHit) < defender.evade and attackRoll < self.maxAttack:
+      return Zero()
+
+    if attackRoll >= 18:
+      criticalHits = max(0, math.floor((attackRoll + attacker.bonusToHit - defender.evade) / 5))
+    else:
+      criticalHits = max(0, math.floor((attackRoll + attacker.bonusToHit - defender.evade) / 10))
+    criticalHits = min(3, criticalHits)
+
+    criticalHitDamage = attacker.damageDie.arithMult(1 + criticalHits).op(lambda a: max(1, a + attacker.bonusToDamage))
+    return criticalHitDamage
+
+  def __eq__(self, other):
+    return type(other) is type(self) and (self.minAttack, self.maxAttack) == (other.minAttack, other.maxAttack)
+
+  def __hash__(self):
+    return hash((type(self).__name__, self.minAttack, self.maxAttack))
+
+  def __repr__(self):
+    return "NealDamageDensity({}, {})".format(self.minAttack, self.maxAttack)
+
+@dependsOn(attacker=("bonusToHit", "bonusToHitUnarmored", "criticalThreshold", "damageDie", "bonusToDamage"), defender=("evade", "resistance"))
+class NealTestDensity:
+  def __init__(self, armored):
+    self.armored = armored
+
+  def __call__(self, attacker, defender, attackRoll):
+    bonusToHit = attacker.bonusToHit if self.armored else attacker.bonusToHitUnarmored
+    excess = attackRoll + bonusToHit - defender.evade
+    if (excess < 0):
+      return Zero()
+
+    if attacker.criticalThreshold is None:
+      criticalHits = 0
+    else:
+      criticalHits = excess // attacker.criticalThreshold
+    damage = attacker.damageDie.arithMult(1 + criticalHits).op(lambda a: max(0, a + attacker.bonusToDamage - defender.resistance))
+    return damage
+
+  def __eq__(self, other):
+    return type(other) is type(self) and self.armored == other.armored
+
+  def __hash__(self):
+    return hash((type(self).__name__, self.armored))
+
+  def __repr__(self):
+    return "NealTestDensity({})".format(self.armored)
+
+
 class Dnd2NealCombatant(DndCombatant):
   def __init__(self, hp, attackDie, bonusToHit, damageDie, bonusToDamage, ac):
-    minAttack = min(attackDie.keys())
-    maxAttack = max(attackDie.keys())
-    def nealDamageDensity(attacker, defender, attackRoll):
-      if attackRoll == minAttack:
-        return Zero()
-      if (attackRoll + attacker.bonusToHit) < defender.evade and attackRoll < maxAttack:
-        return Zero()
-
-      if attackRoll >= 18:
-        criticalHits = max(0, math.floor((attackRoll + attacker.bonusToHit - defender.evade) / 5))
-      else:
-        criticalHits = max(0, math.floor((attackRoll + attacker.bonusToHit - defender.evade) / 10))
-      criticalHits = min(3, criticalHits)
-
-      criticalHitDamage = attacker.damageDie.arithMult(1 + criticalHits).op(lambda a: max(1, a + attacker.bonusToDamage))
-      return criticalHitDamage
+    nealDamageDensity = NealDamageDensity(min(attackDie.keys()), max(attackDie.keys()))
     DndCombatant.__init__(self, hp, attackDie, bonusToHit, damageDie, bonusToDamage, ac, damageDensity = nealDamageDensity)
 
 class DndNealTestCombatant(Combatant):
   def __init__(self, hp, bonusToHit, damageDie, bonusToDamage, evade, criticalThreshold, armor = 0, maxFatigue = None, bonusToHitUnarmored = None):
     if (bonusToHitUnarmored is None):
       bonusToHitUnarmored = bonusToHit
+    nealTestDensity = NealTestDensity(armor > 0)
+    Combatant.__init__(self, hp, d100, bonusToHit, damageDie, bonusToDamage, evade, resistance=armor, maxFatigue=maxFatigue, criticalThreshold=criticalThreshold, damageDensity = nealTestDensity, bonusToHitUnarmored = bonusToHitUnarmored)
+
+
+class DensityQuery:
+  def __init__(self, op):
+    self.op = op
+
+  def _start(self):
+    return {}
+
+  def _add(self, acc, attacker, defender, p):
+    k = self.op(attacker, defender)
+    try:
+      acc[k] += p
+    except KeyError:
+      acc[k] = p
+    return acc
+
+  def _result(self, acc):
+    return Density(acc)
+
+
+class EventQuery:
+  def __init__(self, cond):
+    self.cond = cond
+
+  def _start(self):
+    return 0.0
 
-    def nealTestDensity(attacker, defender, attackRoll):
-      armored = armor > 0
-      bonusToHit = attacker.bonusToHit if armored else attacker.bonusToHitUnarmored
-      excess = attackRoll + bonusToHit - defender.evade
-      if (excess < 0):
-        return Zero()
+  def _add(self, acc, attacker, defender, p):
+    if self.cond(attacker, defender):
+      return acc + p
+    return acc
 
-      if attacker.criticalThreshold is None:
-        criticalHits = 0
+  def _result(self, acc):
+    return acc
+
+
+class CombatSolution:
+  def __init__(self, attacker, defender, chanceDefenderStarts = None, precise = True, simple = False, hpGrid = None):
+    self.attacker = attacker
+    self.defender = defender
+    self.chanceDefenderStarts = chanceDefenderStarts
+    self.precise = precise
+    self.simple = simple
+    self.hpGrid = hpGrid
+    self.rounds = 0
+    self.quantizationError = 0.0
+    self.winMass = 0.0
+    # Decided states don't change the outcome anymore, so only the undecided frontier is simulated further
+    self.decided = {}
+    self.frontier = {}
+
+    d = {(attacker, defender): 1.0}
+    if not chanceDefenderStarts is None:
+      d = Combatant.randomizeInitialAttacker(d, chanceDefenderStarts, precise=precise)
+      if not hpGrid is None:
+        d, error = Combatant._quantizeDistribution(d, hpGrid)
+        self.quantizationError += error
+    self._setFrontier(d)
+
+  def _damageDistributions(self):
+    if not self.simple:
+      return (None, None)
+    return (self.attacker.damageDensityDistribution(self.defender), self.defender.damageDensityDistribution(self.attacker))
+
+  def _setFrontier(self, d):
+    self.frontier = {}
+    for (attacker, defender) in d:
+      pState = d[(attacker, defender)]
+      if attacker.canFight() and defender.canFight():
+        self.frontier[(attacker, defender)] = pState
       else:
-        criticalHits = excess // attacker.criticalThreshold
-      damage = attacker.damageDie.arithMult(1 + criticalHits).op(lambda a: max(0, a + attacker.bonusToDamage - defender.resistance))
-      return damage
-    Combatant.__init__(self, hp, d100, bonusToHit, damageDie, bonusToDamage, evade, resistance=armor, maxFatigue=maxFatigue, criticalThreshold=criticalThreshold, damageDensity = nealTestDensity, bonusToHitUnarmored = bonusToHitUnarmored)
+        if defender.cantFight():
+          self.winMass += pState
+        try:
+          self.decided[(attacker, defender)] += pState
+        except KeyError:
+          self.decided[(attacker, defender)] = pState
+
+  def distribution(self):
+    # a snapshot, later calls of refine don't change it
+    d = dict(self.decided)
+    d.update(self.frontier)
+    return d
+
+  def undecidedProbability(self):
+    return sum(self.frontier.values())
+
+  def refine(self, maxError = 0.005, roundQueries = None, onRound = None, maxRounds = None, deadline = None):
+    # maxRounds limits the total number of rounds, deadline (in seconds) the time spent in this call (checked after every round)
+    start = time.perf_counter()
+    attackerDmgDist, defenderDmgDist = self._damageDistributions()
+    names = list(roundQueries.keys()) if not roundQueries is None else []
+    queryList = [ roundQueries[name] for name in names ]
+    while True:
+      if not onRound is None:
+        onRound(self.rounds, dict(zip(names, Combatant._evaluateQueries(ChainMap(self.frontier, self.decided), queryList))))
+      if self.undecidedProbability() <= maxError:
+        break
+      if not maxRounds is None and self.rounds >= maxRounds:
+        break
+      if not deadline is None and time.perf_counter() - start >= deadline:
+        break
+      d = Combatant._applyAttackRound(self.frontier, precise=self.precise, simple=self.simple, attackerDmgDist=attackerDmgDist, defenderDmgDist=defenderDmgDist)
+      if not self.hpGrid is None:
+        d, error = Combatant._quantizeDistribution(d, self.hpGrid)
+        self.quantizationError += error
+      self._setFrontier(d)
+      self.rounds += 1
+    return self
+
+  def winProbability(self, includeError = False):
+    p = self.winMass
+    up = self.undecidedProbability()
+    if includeError and not self.hpGrid is None:
+      return (p + up*p/(1-up), p, up, self.quantizationError)
+    if includeError:
+      return (p + up*p/(1-up), p, up)
+    return p + up*p/(1-up)
+
+  @staticmethod
+  def _fingerprint(combatant):
+    damageDensity = combatant._damageDensity
+    return [ type(combatant).__name__, combatant.maxFatigue, combatant.bonusToHit, combatant.bonusToDamage,
+      combatant.evade, combatant.armor, combatant.resistance, combatant.criticalThreshold, combatant.bonusToHitUnarmored,
+      [ list(it) for it in combatant.attackDie._state() ], [ list(it) for it in combatant.damageDie._state() ],
+      getattr(damageDensity, '__qualname__', repr(damageDensity)) ]
+
+  @staticmethod
+  def _statesToList(d):
+    return [ [attacker.hp, attacker.fatigue, defender.hp, defender.fatigue, d[(attacker, defender)]] for (attacker, defender) in d ]
+
+  def _statesFromList(self, states):
+    d = {}
+    for aHp, aFatigue, dHp, dFatigue, pState in states:
+      attacker = self.attacker.clone()
+      attacker.hp, attacker.fatigue = aHp, aFatigue
+      defender = self.defender.clone()
+      defender.hp, defender.fatigue = dHp, dFatigue
+      d[(attacker, defender)] = pState
+    return d
+
+  def toDict(self):
+    return {
+      "attacker": [self.attacker.hp, self.attacker.fatigue] + CombatSolution._fingerprint(self.attacker),
+      "defender": [self.defender.hp, self.defender.fatigue] + CombatSolution._fingerprint(self.defender),
+      "chanceDefenderStarts": self.chanceDefenderStarts,
+      "precise": self.precise,
+      "simple": self.simple,
+      "hpGrid": self.hpGrid,
+      "rounds": self.rounds,
+      "quantizationError": self.quantizationError,
+      "winMass": self.winMass,
+      "frontier": CombatSolution._statesToList(self.frontier),
+      "decided": CombatSolution._statesToList(self.decided)
+    }
+
+  @staticmethod
+  def fromDict(data, attacker, defender):
+    # The combatants can't be serialized (damage density functions), they have to be the same ones as used for the solution
+    attackerFingerprint = [attacker.hp, attacker.fatigue] + CombatSolution._fingerprint(attacker)
+    defenderFingerprint = [defender.hp, defender.fatigue] + CombatSolution._fingerprint(defender)
+    if json.loads(json.dumps([attackerFingerprint, defenderFingerprint])) != [data["attacker"], data["defender"]]:
+      raise ValueError("The combatants don't match the ones of the saved combat solution!")
+    solution = CombatSolution.__new__(CombatSolution)
+    solution.attacker = attacker
+    solution.defender = defender
+    solution.chanceDefenderStarts = data["chanceDefenderStarts"]
+    solution.precise = data["precise"]
+    solution.simple = data["simple"]
+    solution.hpGrid = data["hpGrid"]
+    solution.rounds = data["rounds"]
+    solution.quantizationError = data["quantizationError"]
+    solution.winMass = data["winMass"]
+    solution.frontier = solution._statesFromList(data["frontier"])
+    solution.decided = solution._statesFromList(data["decided"])
+    return solution
+
+  def save(self, filename):
+    with open(filename, "w") as f:
+      json.dump(self.toDict(), f)
+
+  @staticmethod
+  def load(filename, attacker, defender):
+    with open(filename) as f:
+      return CombatSolution.fromDict(json.load(f), attacker, defender)
@@ -0,0 +1,223 @@
+from combatant import *
+from collections import OrderedDict
+import threading
+
+_profileFields = ("hp", "attackDie", "bonusToHit", "damageDie", "bonusToDamage", "evade", "armor", "resistance", "maxFatigue", "fatigue", "criticalThreshold", "damageDensity", "bonusToHitUnarmored")
+
+def _fieldValue(combatant, field):
+  if field == "fatigueState":
+    return combatant.fatigueState()
+  if field == "damageDensity":
+    return combatant._damageDensity
+  value = getattr(combatant, field)
+  if isinstance(value, Density):
+    return value._state()
+  return value
+
+def _fieldValues(combatant, fields):
+  return tuple([(field, _fieldValue(combatant, field)) for field in fields])
+
+
+class ArtifactCache:
+  # Derived results are stored under the values of the fields they depend on,
+  # so changing a field only leads to recalculations of the results depending on it.
+  # At most maxSize results are kept, the least recently used results are removed first (maxSize=None: no limit).
+  def __init__(self, maxSize = 100000):
+    self.maxSize = maxSize
+    self.artifacts = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
+
+  def get(self, key, compute):
+    with self._lock:
+      try:
+        value = self.artifacts[key]
+        self.artifacts.move_to_end(key)
+        self.hits += 1
+        return value
+      except KeyError:
+        self.misses += 1
+    value = compute()
+    self.put(key, value)
+    return value
+
+  def put(self, key, value):
+    with self._lock:
+      self.artifacts[key] = value
+      self.artifacts.move_to_end(key)
+      while not self.maxSize is None and len(self.artifacts) > self.maxSize:
+        self.artifacts.popitem(last=False)
+
+  def clear(self):
+    with self._lock:
+      self.artifacts = OrderedDict()
+      self.hits = 0
+      self.misses = 0
+
+  def __len__(self):
+    return len(self.artifacts)
+
+  def __getstate__(self):
+    state = dict(self.__dict__)
+    del state["_lock"]
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def damageKey(attacker, defender):
+    # Damage densities without declared dependencies (see dependsOn) depend on all fields
+    damageDensity = attacker._damageDensity
+    attackerFields = getattr(damageDensity, "attackerFields", _profileFields + ("fatigueState",))
+    defenderFields = getattr(damageDensity, "defenderFields", _profileFields + ("fatigueState",))
+    return (damageDensity, _fieldValues(attacker, ("attackDie",) + attackerFields), _fieldValues(defender, defenderFields))
+
+  @staticmethod
+  def combatantKey(combatant):
+    return _fieldValues(combatant, _profileFields)
+
+  @staticmethod
+  def transitionKey(attacker, defender, precise):
+    # The attacked defender depends on the damage densities, on whether the attacker can fight and on all fields of the defender
+    return (ArtifactCache.damageKey(attacker, defender), (attacker.hp, attacker.fatigue, attacker.maxFatigue), ArtifactCache.combatantKey(defender), precise)
+
+artifactCache = ArtifactCache()
+
+
+class _ProfiledCombatant(Combatant):
+  def __init__(self, hp, attackDie, bonusToHit, damageDie, bonusToDamage, evade, armor = 0, resistance = 0, maxFatigue = None, fatigue = 0, criticalThreshold = 5, damageDensity = None, bonusToHitUnarmored = None, cache = None):
+    Combatant.__init__(self, hp, attackDie, bonusToHit, damageDie, bonusToDamage, evade, armor, resistance, maxFatigue, fatigue, criticalThreshold, damageDensity, bonusToHitUnarmored)
+    self._artifactCache = artifactCache if cache is None else cache
+
+  def __getstate__(self):
+    # the global cache isn't copied into other processes, they use their own global cache
+    state = dict(self.__dict__)
+    if state["_artifactCache"] is artifactCache:
+      state["_artifactCache"] = None
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    if self._artifactCache is None:
+      self._artifactCache = artifactCache
+
+  def clone(self):
+    return _ProfiledCombatant(self.hp, self.attackDie, self.bonusToHit, self.damageDie, self.bonusToDamage, self.evade, self.armor, self.resistance, self.maxFatigue, self.fatigue, self.criticalThreshold, self._damageDensity, self.bonusToHitUnarmored, self._artifactCache)
+
+  def damageDensityDistribution(self, defender, cond=None):
+    if not cond is None:
+      return Combatant.damageDensityDistribution(self, defender, cond)
+    key = ("damageDensityDistribution", ArtifactCache.damageKey(self, defender))
+    return self._artifactCache.get(key, lambda: Combatant.damageDensityDistribution(self, defender))
+
+  def _attackTransition(self, defender, precise=True, damageDensityDistribution=None):
+    if not damageDensityDistribution is None:
+      return Combatant._attackTransition(self, defender, precise, damageDensityDistribution)
+    key = ("attackTransition", ArtifactCache.transitionKey(self, defender, precise))
+    return self._artifactCache.get(key, lambda: Combatant._attackTransition(self, defender, precise))
+
+  def chanceToHit(self, defender):
+    key = ("chanceToHit", ArtifactCache.damageKey(self, defender))
+    return self._artifactCache.get(key, lambda: Combatant.chanceToHit(self, defender))
+
+  def attackDamageDensity(self, defender, cond=None):
+    if not cond is None:
+      return Combatant.attackDamageDensity(self, defender, cond)
+    key = ("attackDamageDensity", ArtifactCache.damageKey(self, defender))
+    return self._artifactCache.get(key, lambda: Combatant.attackDamageDensity(self, defender))
+
+  def expectedDamage(self, defender, cond=None):
+    if not cond is None:
+      return Combatant.expectedDamage(self, defender, cond)
+    key = ("expectedDamage", ArtifactCache.damageKey(self, defender))
+    return self._artifactCache.get(key, lambda: Combatant.expectedDamage(self, defender))
+
+  def plotDamage(self, defender):
+    key = ("plotDamage", ArtifactCache.damageKey(self, defender))
+    return self._artifactCache.get(key, lambda: Combatant.plotDamage(self, defender))
+
+  def winProbability(self, defender, chanceDefenderStarts = None, precise = True, simple = False, maxError = 0.005, includeError = False, hpGrid = None, roundQueries = None, onRound = None):
+    compute = lambda: Combatant.winProbability(self, defender, chanceDefenderStarts, precise, simple, maxError, includeError, hpGrid, roundQueries, onRound)
+    if not roundQueries is None or not onRound is None:
+      return compute()
+    key = ("winProbability", ArtifactCache.combatantKey(self), ArtifactCache.combatantKey(defender), (chanceDefenderStarts, precise, simple, maxError, includeError, hpGrid))
+    return self._artifactCache.get(key, compute)
+
+
+class CombatantProfile:
+  # Immutable combatant description, derived results are cached (see ArtifactCache) and shared between profiles
+  def __init__(self, hp, attackDie, bonusToHit, damageDie, bonusToDamage, evade, armor = 0, resistance = 0, maxFatigue = None, fatigue = 0, criticalThreshold = 5, damageDensity = None, bonusToHitUnarmored = None, cache = None):
+    if damageDensity is None:
+      damageDensity = Combatant.defaultDamageDensity
+    values = (hp, attackDie, bonusToHit, damageDie, bonusToDamage, evade, armor, resistance, maxFatigue, fatigue, criticalThreshold, damageDensity, bonusToHitUnarmored)
+    object.__setattr__(self, "_values", dict(zip(_profileFields, values)))
+    object.__setattr__(self, "_cache", cache)
+    object.__setattr__(self, "_combatant", None)
+
+  @staticmethod
+  def fromCombatant(combatant, cache = None):
+    return CombatantProfile(combatant.hp, combatant.attackDie, combatant.bonusToHit, combatant.damageDie, combatant.bonusToDamage, combatant.evade, combatant.armor, combatant.resistance, combatant.maxFatigue, combatant.fatigue, combatant.criticalThreshold, combatant._damageDensity, combatant.bonusToHitUnarmored, cache)
+
+  def replace(self, **changes):
+    values = dict(self._values)
+    for field in changes:
+      if not field in values:
+        raise TypeError("Unknown combatant field: {}".format(field))
+      values[field] = changes[field]
+    return CombatantProfile(cache = self._cache, **values)
+
+  def _profiledCombatant(self):
+    # internal instance (used for the cache keys, never handed out)
+    if self._combatant is None:
+      object.__setattr__(self, "_combatant", _ProfiledCombatant(cache = self._cache, **self._values))
+    return self._combatant
+
+  def combatant(self):
+    # Returns a new (mutable) combatant, changing it doesn't affect the profile
+    return self._profiledCombatant().clone()
+
+  def __getstate__(self):
+    return (self._values, self._cache)
+
+  def __setstate__(self, state):
+    object.__setattr__(self, "_values", state[0])
+    object.__setattr__(self, "_cache", state[1])
+    object.__setattr__(self, "_combatant", None)
+
+  def __setattr__(self, name, value):
+    raise AttributeError("CombatantProfile is immutable, use replace({}=...) instead".format(name))
+
+  def __getattr__(self, name):
+    if name.startswith("_"):
+      raise AttributeError(name)
+    if name in self._values:
+      return self._values[name]
+    # Everything else is answered by the corresponding (cached) combatant
+    attr = getattr(self._profiledCombatant(), name)
+    if not callable(attr):
+      return attr
+    def method(*args, **kwargs):
+      args = [arg._profiledCombatant() if isinstance(arg, CombatantProfile) else arg for arg in args]
+      kwargs = { k: (v._profiledCombatant() if isinstance(v, CombatantProfile) else v) for k, v in kwargs.items() }
+      return attr(*args, **kwargs)
+    return method
+
+  def _key(self):
+    return ArtifactCache.combatantKey(self._profiledCombatant())
+
+  def __hash__(self):
+    return hash(self._key())
+
+  def __eq__(self, other):
+    if not isinstance(other, CombatantProfile):
+      return NotImplemented
+    return self._key() == other._key()
+
+  def __str__(self):
+    return "CombatantProfile({})".format(", ".join(["{}={}".format(field, self._values[field]) for field in _profileFields if not isinstance(self._values[field], Density) and not callable(self._values[field])]))
+
+  def __repr__(self):
+    return self.__str__()
@@ -2,11 +2,13 @@ import ast
 import operator as op
 import re
 import math
-import heapq
-import matplotlib.pyplot as plt
 import random
+import threading
+import time
 import weakref
+import numpy as np
 from itertools import product
+from fractions import Fraction
 from functools import reduce, lru_cache, wraps
 from statistics import median
 
@@ -15,31 +17,207 @@ _operators = {ast.Add: op.add, ast.Sub: op.sub, ast.Mult: op.mul,
              ast.USub: op.neg,
              ast.Eq: op.eq, ast.NotEq: op.ne, ast.Lt: op.lt, ast.LtE: op.le, ast.Gt: op.gt, ast.GtE: op.ge}
 
+# observer(name, event, details) is informed about every call (event "call", details (self, args, result, start, end))
+# and every cache miss (event "miss", details None) of memoized methods (see instrumentation.py)
+_memoizedObserver = None
+
 def memoized_method(*lru_args, **lru_kwargs):
     def decorator(func):
+        # Only taken while creating the cache of an instance, later calls
+        # directly go to the cached method stored on the instance.
+        lock = threading.Lock()
         @wraps(func)
         def wrapped_func(self, *args, **kwargs):
-            # We're storing the wrapped method inside the instance. If we had
-            # a strong reference to self the instance would never die.
-            self_weak = weakref.ref(self)
-            @wraps(func)
-            @lru_cache(*lru_args, **lru_kwargs)
-            def cached_method(*args, **kwargs):
-                return func(self_weak(), *args, **kwargs)
-            setattr(self, func.__name__, cached_method)
+            with lock:
+                cached_method = self.__dict__.get(func.__name__)
+                if cached_method is None:
+                    cached_method = _cachedMethod(self, func, lru_args, lru_kwargs)
+                    setattr(self, func.__name__, cached_method)
             return cached_method(*args, **kwargs)
         return wrapped_func
     return decorator
 
-def _eval_expr(expr):
-    return _eval(ast.parse(expr, mode='eval').body)
+def _cachedMethod(self, func, lru_args, lru_kwargs):
+    # We're storing the wrapped method inside the instance. If we had
+    # a strong reference to self the instance would never die.
+    self_weak = weakref.ref(self)
+    @lru_cache(*lru_args, **lru_kwargs)
+    def cached(*args, **kwargs):
+        observer = _memoizedObserver
+        if not observer is None:
+            observer(func.__qualname__, "miss", None)
+        return func(self_weak(), *args, **kwargs)
+    @wraps(func)
+    def cached_method(*args, **kwargs):
+        observer = _memoizedObserver
+        if observer is None:
+            return cached(*args, **kwargs)
+        start = time.perf_counter()
+        res = cached(*args, **kwargs)
+        observer(func.__qualname__, "call", (self_weak(), args, res, start, time.perf_counter()))
+        return res
+    return cached_method
+
+_dieTokenPattern = re.compile(r'(m(\d*))?(a*|d*)d(\d+)')
+
+def _isNumber(node):
+  return isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool)
+
+def _dieToken(node):
+  # (count, prefix, die) for names like m3ad20, None for anything else
+  if not isinstance(node, ast.Name):
+    return None
+  match = _dieTokenPattern.fullmatch(node.id)
+  if match is None:
+    return None
+  nr = int(match.group(2)) if match.group(2) else 1
+  return (nr, match.group(3), int(match.group(4)))
+
+_poolTokenPattern = re.compile(r'p(\d+)(a*|d*)d(\d+)s(\d+)(s(\d+))?')
+
+def _poolToken(node):
+  # (count, prefix, die, thresholds) for dice pool names like p10d10s8 or p10d10s8s10
+  if not isinstance(node, ast.Name):
+    return None
+  match = _poolTokenPattern.fullmatch(node.id)
+  if match is None:
+    return None
+  thresholds = [ int(match.group(4)) ]
+  if match.group(6):
+    thresholds.append(int(match.group(6)))
+  return (int(match.group(1)), match.group(2), int(match.group(3)), thresholds)
+
+def _baseDie(prefix, die):
+  if prefix.startswith("a"):
+    return AdvantageDie(die, len(prefix) + 1)
+  elif prefix.startswith("d"):
+    return DisadvantageDie(die, len(prefix) + 1)
+  else:
+    return Die(die)
+
+def _dieTokenNode(nr, prefix, die):
+  if nr == 1:
+    return ast.Name(id="{}d{}".format(prefix, die), ctx=ast.Load())
+  return ast.Name(id="m{}{}d{}".format(nr, prefix, die), ctx=ast.Load())
+
+def _supportEstimate(node):
+  if _isNumber(node):
+    return 1
+  token = _dieToken(node)
+  if token is not None:
+    nr, prefix, die = token
+    return nr*(die - 1) + 1
+  pool = _poolToken(node)
+  if pool is not None:
+    nr, prefix, die, thresholds = pool
+    return nr*len(thresholds) + 1
+  if isinstance(node, ast.UnaryOp):
+    return _supportEstimate(node.operand)
+  if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Sub)):
+    return _supportEstimate(node.left) + _supportEstimate(node.right) - 1
+  if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Mult):
+    return _supportEstimate(node.left) * _supportEstimate(node.right)
+  return 1
+
+def _collectSummands(node, sign, summands):
+  if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Sub)):
+    _collectSummands(node.left, sign, summands)
+    _collectSummands(node.right, sign if isinstance(node.op, ast.Add) else -sign, summands)
+  elif isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+    _collectSummands(node.operand, -sign if isinstance(node.op, ast.USub) else sign, summands)
+  else:
+    summands.append((sign, _simplify(node)))
 
-def _eval(node):
-  if isinstance(node, ast.Num):
-    return Constant(node.n)
+def _collectFactors(node, factors):
+  if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Mult):
+    _collectFactors(node.left, factors)
+    _collectFactors(node.right, factors)
+  else:
+    factors.append(_simplify(node))
+
+def _simplifySum(node):
+  summands = []
+  _collectSummands(node, 1, summands)
+  shift = 0
+  dice = {}
+  terms = []
+  for sign, term in summands:
+    token = _dieToken(term)
+    if _isNumber(term):
+      shift += sign*term.value
+    elif token is not None:
+      # Identical dice with the same sign are rolled independently, so they can be merged into m<n>
+      nr, prefix, die = token
+      dice[(sign, prefix, die)] = dice.get((sign, prefix, die), 0) + nr
+    else:
+      terms.append((sign, term))
+  for (sign, prefix, die), nr in dice.items():
+    terms.append((sign, _dieTokenNode(nr, prefix, die)))
+  # Convolve small supports first, the constant shift is applied last
+  terms.sort(key=lambda t: _supportEstimate(t[1]))
+  if not terms:
+    return ast.Constant(value=shift)
+  sign, res = terms[0]
+  if sign < 0:
+    res = ast.UnaryOp(op=ast.USub(), operand=res)
+  for sign, term in terms[1:]:
+    res = ast.BinOp(left=res, op=ast.Add() if sign > 0 else ast.Sub(), right=term)
+  if shift != 0:
+    res = ast.BinOp(left=res, op=ast.Add() if shift > 0 else ast.Sub(), right=ast.Constant(value=abs(shift)))
+  return res
+
+def _simplifyProduct(node):
+  factors = []
+  _collectFactors(node, factors)
+  factor = 1
+  terms = []
+  for term in factors:
+    if _isNumber(term):
+      factor *= term.value
+    else:
+      terms.append(term)
+  if not terms or factor == 0:
+    return ast.Constant(value=factor if not terms else 0)
+  terms.sort(key=_supportEstimate)
+  res = terms[0]
+  for term in terms[1:]:
+    res = ast.BinOp(left=res, op=ast.Mult(), right=term)
+  if factor != 1:
+    res = ast.BinOp(left=res, op=ast.Mult(), right=ast.Constant(value=factor))
+  return res
+
+def _simplify(node):
+  # Rewrite the parsed expression such that as few (expensive) convolutions as possible are needed
+  if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Sub)):
+    return _simplifySum(node)
+  if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+    return _simplifySum(node)
+  if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Mult):
+    return _simplifyProduct(node)
+  if isinstance(node, ast.Compare) and len(node.ops) == 1 and len(node.comparators) == 1:
+    return ast.Compare(left=_simplify(node.left), ops=node.ops, comparators=[_simplify(node.comparators[0])])
+  return node
+
+def _parse_expr(expr, simplify=True):
+  node = ast.parse(expr, mode='eval').body
+  if simplify:
+    node = _simplify(node)
+  return node
+
+def _eval_expr(expr, lazy=False, simplify=True):
+    return _eval(_parse_expr(expr, simplify), lazy)
+
+def _eval(node, lazy=False):
+  if _isNumber(node):
+    return Constant(node.value)
   elif isinstance(node, ast.Name):
     nodeStr = node.id
-    match = re.search(r'(m(\d*))?([ad]?)d(\d+)', nodeStr)
+    pool = _poolToken(node)
+    if not pool is None:
+      nr, prefix, die, thresholds = pool
+      resDensity = _baseDie(prefix, die).successCount(nr, *thresholds)
+      return resDensity.lazy() if lazy else resDensity
+    match = _dieTokenPattern.search(nodeStr)
     if match is None:
       raise TypeError(node)
     else:
@@ -47,25 +225,167 @@ def _eval(node):
         nr = int(match.group(2))
       else:
         nr = 1
-      die = int(match.group(4))
-      if match.group(3) == "a":
-        resDensity = AdvantageDie(die)
-      elif match.group(3) == "d":
-        resDensity = DisadvantageDie(die)
-      else:
-        resDensity = Die(die)
+      resDensity = _baseDie(match.group(3), int(match.group(4)))
+      if lazy:
+        resDensity = resDensity.lazy()
       return resDensity.arithMult(nr)
   elif isinstance(node, ast.BinOp):
-      return _operators[type(node.op)](_eval(node.left), _eval(node.right))
+      return _operators[type(node.op)](_eval(node.left, lazy), _eval(node.right, lazy))
   elif isinstance(node, ast.UnaryOp):
-      return _operators[type(node.op)](_eval(node.operand))
+      return _operators[type(node.op)](_eval(node.operand, lazy))
   elif isinstance(node, ast.Compare) and len(node.ops) == 1 and len(node.comparators) == 1:
-      return _operators[type(node.ops[0])](_eval(node.left), _eval(node.comparators[0]))
+      return _operators[type(node.ops[0])](_eval(node.left, lazy), _eval(node.comparators[0], lazy))
   else:
       raise TypeError(node)
 
-def DieExpr(expr):
-  return _eval_expr(expr)
+def DieExpr(expr, lazy=False, simplify=True, budget=None, onBudgetExceeded="raise"):
+  if budget is None:
+    return _eval_expr(expr, lazy, simplify)
+  if not onBudgetExceeded in ("raise", "sample", "continue"):
+    raise ValueError("onBudgetExceeded must be 'raise', 'sample' or 'continue'!")
+  start = time.perf_counter()
+  node = _parse_expr(expr, simplify)
+  estimate = _estimateNode(node)
+  violations = budget.violations(estimate)
+  if violations and onBudgetExceeded == "raise":
+    raise BudgetExceededError(expr, estimate, violations)
+  if violations and onBudgetExceeded == "sample":
+    # imported here since sampling depends on densities
+    from sampling import estimateExpression
+    deadline = None if budget.deadline is None else max(0.0, budget.deadline - (time.perf_counter() - start))
+    return estimateExpression(expr, simplify=simplify, deadline=deadline)
+  return _eval(node, lazy)
+
+def DieExprCost(expr, simplify=True):
+  return _estimateNode(_parse_expr(expr, simplify))
+
+# Rough durations in seconds of an elementary operation (one pair of outcomes in binOp resp. in a comparison)
+# and of a convolution (see Density._convolve, per call, per outcome of the inputs and per pair of outcomes)
+_secondsPerOperation = 4e-7
+_secondsPerComparison = 1.4e-7
+_secondsPerConvolution = 2e-5
+_secondsPerConvolutionOutcome = 2e-7
+_secondsPerConvolutionPair = 3e-10
+
+def _convolutionSeconds(calls, outcomes, pairs):
+  return calls*_secondsPerConvolution + outcomes*_secondsPerConvolutionOutcome + pairs*_secondsPerConvolutionPair
+
+def _estimateNode(node):
+  # Mirrors _eval: estimated support, number of elementary operations, largest product space and duration
+  if _isNumber(node):
+    return CostEstimate(1, 0, 1, 0.0, isinstance(node.value, int))
+  token = _dieToken(node)
+  if token is not None:
+    nr, prefix, die = token
+    # arithMult adds the die nr-1 times to the running sum (with supports k*(die-1)+1 for k = 1, ..., nr-1)
+    summedSupports = (die - 1)*nr*(nr - 1)//2 + nr - 1
+    baseOperations = die*(len(prefix) + 1)
+    operations = die*summedSupports + baseOperations
+    seconds = baseOperations*_secondsPerOperation + _convolutionSeconds(nr - 1, summedSupports + (nr - 1)*die, die*summedSupports)
+    return CostEstimate(nr*(die - 1) + 1, operations, ((nr - 1)*(die - 1) + 1)*die, seconds, True)
+  pool = _poolToken(node)
+  if pool is not None:
+    nr, prefix, die, thresholds = pool
+    return CostEstimate(nr*len(thresholds) + 1, nr*len(thresholds)**2 + die*(len(prefix) + 1), die, None, True)
+  if isinstance(node, ast.UnaryOp):
+    estimate = _estimateNode(node.operand)
+    return CostEstimate(estimate.support, estimate.operations + estimate.support, estimate.productSize,
+                        estimate.seconds + estimate.support*_secondsPerOperation, estimate.isInteger)
+  if isinstance(node, ast.BinOp):
+    return _estimateBinary(_estimateNode(node.left), _estimateNode(node.right), isinstance(node.op, ast.Mult))
+  if isinstance(node, ast.Compare) and len(node.ops) == 1 and len(node.comparators) == 1:
+    left = _estimateNode(node.left)
+    right = _estimateNode(node.comparators[0])
+    pairs = left.support*right.support
+    return CostEstimate(1, left.operations + right.operations + pairs, max(left.productSize, right.productSize, pairs),
+                        left.seconds + right.seconds + pairs*_secondsPerComparison)
+  raise TypeError(node)
+
+def _estimateBinary(left, right, isProduct):
+  operations = left.operations + right.operations
+  seconds = left.seconds + right.seconds
+  productSize = max(left.productSize, right.productSize)
+  isInteger = left.isInteger and right.isInteger
+  if left.support == 1 or right.support == 1:
+    # constants only shift resp. scale the outcomes
+    support = left.support*right.support
+    return CostEstimate(support, operations + support, productSize, seconds + support*_secondsPerOperation, isInteger)
+  pairs = left.support*right.support
+  support = pairs if isProduct else left.support + right.support - 1
+  if not isProduct and isInteger and pairs >= _minConvolutionSize:
+    # additions of integer densities are convolutions (see Density.__add__)
+    seconds += _convolutionSeconds(1, left.support + right.support, pairs)
+  else:
+    seconds += pairs*_secondsPerOperation
+  return CostEstimate(support, operations + pairs, max(productSize, pairs), seconds, isInteger)
+
+class CostEstimate:
+  # seconds defaults to operations elementary (binOp) operations, isInteger: whether all outcomes are integers
+  def __init__(self, support, operations, productSize, seconds = None, isInteger = False):
+    self.support = support
+    self.operations = operations
+    self.productSize = productSize
+    self.seconds = operations*_secondsPerOperation if seconds is None else seconds
+    self.isInteger = isInteger
+
+  def __str__(self):
+    return "CostEstimate(support = {}, productSize = {}, operations = {}, seconds = {:.3g})".format(self.support, self.productSize, self.operations, self.seconds)
+
+  def __repr__(self):
+    return self.__str__()
+
+class Budget:
+  def __init__(self, maxSupport=None, maxProductSize=None, deadline=None):
+    self.maxSupport = maxSupport
+    self.maxProductSize = maxProductSize
+    self.deadline = deadline
+
+  def violations(self, estimate):
+    violations = []
+    if not self.maxSupport is None and estimate.support > self.maxSupport:
+      violations.append("support {} > {}".format(estimate.support, self.maxSupport))
+    if not self.maxProductSize is None and estimate.productSize > self.maxProductSize:
+      violations.append("product size {} > {}".format(estimate.productSize, self.maxProductSize))
+    if not self.deadline is None and estimate.seconds > self.deadline:
+      violations.append("estimated time {:.3g}s > {}s".format(estimate.seconds, self.deadline))
+    return violations
+
+  def check(self, estimate, description="The calculation"):
+    violations = self.violations(estimate)
+    if violations:
+      raise BudgetExceededError(description, estimate, violations)
+
+class BudgetExceededError(ValueError):
+  def __init__(self, description, estimate, violations):
+    ValueError.__init__(self, "{} exceeds the budget: {}".format(description, ", ".join(violations)))
+    self.description = description
+    self.estimate = estimate
+    self.violations = violations
+
+  def __reduce__(self):
+    # e.g. raised in worker processes
+    return (BudgetExceededError, (self.description, self.estimate, self.violations))
+
+def _thresholdProbabilities(density, thresholds, cond):
+  # P(density cond t) for every t in thresholds, using prefix/suffix sums instead of a double loop
+  keys, probs = density._getArrays()
+  below = np.concatenate(([0.0], np.cumsum(probs)))
+  above = np.concatenate((np.cumsum(probs[::-1])[::-1], [0.0]))
+  left = np.searchsorted(keys, thresholds, side='left')
+  right = np.searchsorted(keys, thresholds, side='right')
+  if cond is op.le:
+    return below[right]
+  if cond is op.lt:
+    return below[left]
+  if cond is op.ge:
+    return above[left]
+  if cond is op.gt:
+    return above[right]
+  if cond is op.eq:
+    return below[right] - below[left]
+  if cond is op.ne:
+    return below[left] + above[right]
+  raise ValueError("cond must be one of the comparison operators from the operator module!")
 
 
 def plot_line(p, minP, maxP, plotWidth):
@@ -80,9 +400,14 @@ def plot_line(p, minP, maxP, plotWidth):
   correctedZeroPosition = int(round(1.0*(correctedZero-minP)*plotWidth/(maxP-minP)))
   pPosition = int(round(1.0*(p-minP)*plotWidth/(maxP-minP)))
 
-  mainContent = pPosition*'█' + (plotWidth-pPosition)*' '
+  # the bar is built from its pieces (with the zero mark '│' inside the plot area)
   if correctedZeroPosition > 0 and correctedZeroPosition < plotWidth:
-    mainContent = mainContent[:correctedZeroPosition] + '│' + mainContent[correctedZeroPosition + 1:]
+    if correctedZeroPosition < pPosition:
+      mainContent = correctedZeroPosition*'█' + '│' + (pPosition-correctedZeroPosition-1)*'█' + (plotWidth-pPosition)*' '
+    else:
+      mainContent = pPosition*'█' + (correctedZeroPosition-pPosition)*' ' + '│' + (plotWidth-correctedZeroPosition-1)*' '
+  else:
+    mainContent = pPosition*'█' + (plotWidth-pPosition)*' '
 
   if belowMin:
     result = '│'
@@ -107,16 +432,17 @@ def centered_plot_line(p, minP, maxP, plotWidth):
 
   correctedZeroPosition = int(round(1.0*(correctedZero-minP)*plotWidth/(maxP-minP)))
   pPosition = int(round(1.0*(p-minP)*plotWidth/(maxP-minP)))
-  relPosition = pPosition-correctedZeroPosition
-
-  mainContent = plotWidth*' '
-  if relPosition >= 0:
-    mainContent = mainContent[:correctedZeroPosition] + relPosition*'█' + mainContent[correctedZeroPosition + relPosition:]
-  else:
-    mainContent = mainContent[:correctedZeroPosition + relPosition] + (-relPosition)*'█' + mainContent[correctedZeroPosition:]
 
+  # the bar goes from the zero position to pPosition (with the zero mark '│' inside the plot area)
   if correctedZeroPosition > 0 and correctedZeroPosition < plotWidth:
-    mainContent = mainContent[:correctedZeroPosition] + '│' + mainContent[correctedZeroPosition + 1:]
+    if correctedZeroPosition <= pPosition:
+      mainContent = correctedZeroPosition*' ' + '│' + max(0, pPosition-correctedZeroPosition-1)*'█' + (plotWidth-max(pPosition, correctedZeroPosition+1))*' '
+    else:
+      mainContent = pPosition*' ' + (correctedZeroPosition-pPosition)*'█' + '│' + (plotWidth-correctedZeroPosition-1)*' '
+  else:
+    lower = min(pPosition, correctedZeroPosition)
+    upper = max(pPosition, correctedZeroPosition)
+    mainContent = lower*' ' + (upper-lower)*'█' + (plotWidth-upper)*' '
 
   if belowMin or correctedZero > 0:
     result = '█'
@@ -129,11 +455,31 @@ def centered_plot_line(p, minP, maxP, plotWidth):
     result += '│'
   return result
 
-def get_plot(p, inputs = range(-20, 20 + 1), plotWidth = 50, minP = None, maxP = None, asPercentage = False, centered = True):
+def _mean(values):
+  return sum(values)/len(values)
+
+def _plotRows(p, inputs, maxRows = None, aggregate = _mean):
+  # Evaluates p once per input. If there are more than maxRows inputs then consecutive inputs
+  # are combined into bins whose value is aggregated (e.g. sum for probabilities)
+  rows = [ (round(k,4), p(k)) for k in inputs ]
+  if maxRows is None or len(rows) <= maxRows:
+    return rows
+  binSize = math.ceil(len(rows)/maxRows)
+  return [ ("{}..{}".format(rows[i][0], rows[min(i + binSize, len(rows)) - 1][0]), aggregate([ v for (k, v) in rows[i:i + binSize] ]))\
+    for i in range(0, len(rows), binSize) ]
+
+def _writeLines(lines, file):
+  if file is None:
+    return str.join("\n", lines)
+  for line in lines:
+    file.write(line + "\n")
+
+def get_plot(p, inputs = range(-20, 20 + 1), plotWidth = 50, minP = None, maxP = None, asPercentage = False, centered = True, maxRows = None, aggregate = _mean, file = None):
+  rows = _plotRows(p, inputs, maxRows, aggregate)
   if minP is None:
-    minP = min(0, min([p(k) for k in inputs]))
+    minP = min(0, min([v for (k, v) in rows]))
   if maxP is None:
-    maxP = max(0, max([p(k) for k in inputs]))
+    maxP = max(0, max([v for (k, v) in rows]))
   if asPercentage:
     formatString = "{0:>12}\t{1:>12.2%}\t{2}"
   else:
@@ -143,46 +489,106 @@ def get_plot(p, inputs = range(-20, 20 + 1), plotWidth = 50, minP = None, maxP =
   else:
     plotFunction = plot_line
 
-  return str.join("\n",list(map(lambda k:\
-    formatString.format(\
-      round(k,4),\
-      round(p(k), 4),\
-      plotFunction(p(k),minP,maxP,plotWidth)\
-    ), inputs)))
+  return _writeLines((formatString.format(k, round(v, 4), plotFunction(v, minP, maxP, plotWidth)) for (k, v) in rows), file)
 
-def get_simple_plot(p, inputs = range(-20, 20 + 1), plotWidth = 50, minP = None, maxP = None, asPercentage = False, centered = True):
+def get_simple_plot(p, inputs = range(-20, 20 + 1), plotWidth = 50, minP = None, maxP = None, asPercentage = False, centered = True, maxRows = None, aggregate = _mean, file = None):
   if asPercentage:
     formatString = "{0:.2%}"
   else:
     formatString = "{0}"
-  return str.join("\n",list(map(lambda k:\
-    formatString.format(round(p(k), 4)),\
-    inputs)))
+  return _writeLines((formatString.format(round(v, 4)) for (k, v) in _plotRows(p, inputs, maxRows, aggregate)), file)
 
 def plot_image(p, inputs = range(-20, 20 + 1), name = None, xlabel = "Input", ylabel = "Output", fmt='-', **kwargs):
-  if name is None:
-    if p.__name__ == '<lambda>':
-      name = "plot"
-    else:
-      name = p.__name__
-
-  fig = plt.figure()
-  plt.title(name)
-  plt.xlabel(xlabel)
-  plt.ylabel(ylabel)
+  _renderPlotJobs([PlotJob.fromFunction(p, inputs, name, xlabel, ylabel, fmt, **kwargs)], None, None, None)
+
+class PlotJob:
+  # Precomputed values of one image plot (picklable, such that it can be rendered by a worker process)
+  def __init__(self, name, inputs, outputs, xlabel = "Input", ylabel = "Output", fmt='-', **kwargs):
+    self.name = name
+    self.inputs = list(inputs)
+    self.outputs = list(outputs)
+    self.xlabel = xlabel
+    self.ylabel = ylabel
+    self.fmt = fmt
+    self.kwargs = kwargs
 
-  outputs = [p(k) for k in inputs]
-  plt.xlim([min(inputs), max(inputs)])
-  plt.plot(inputs, outputs, fmt, **kwargs)
-  plt.scatter(inputs, outputs)
-  plt.grid(True)
-
-  plt.savefig(name)
-  plt.close(fig)
+  @staticmethod
+  def fromFunction(p, inputs = range(-20, 20 + 1), name = None, xlabel = "Input", ylabel = "Output", fmt='-', **kwargs):
+    if name is None:
+      if p.__name__ == '<lambda>':
+        name = "plot"
+      else:
+        name = p.__name__
+    inputs = list(inputs)
+    return PlotJob(name, inputs, [p(k) for k in inputs], xlabel, ylabel, fmt, **kwargs)
+
+def _renderPlotJobs(jobs, format, dpi, directory):
+  # One figure (with a non-interactive canvas) is reused for all jobs
+  from matplotlib.figure import Figure
+  from matplotlib.backends.backend_agg import FigureCanvasAgg
+  import os
+  fig = Figure()
+  FigureCanvasAgg(fig)
+  ax = fig.add_subplot()
+  ax.grid(True)
+  artists = []
+  filenames = []
+  for job in jobs:
+    # only the plotted data is replaced (clearing the axes would rebuild all ticks)
+    for artist in artists:
+      artist.remove()
+    ax.set_prop_cycle(None)
+    ax.set_title(job.name)
+    ax.set_xlabel(job.xlabel)
+    ax.set_ylabel(job.ylabel)
+    artists = ax.plot(job.inputs, job.outputs, job.fmt, **job.kwargs)
+    artists.append(ax.scatter(job.inputs, job.outputs))
+    ax.relim()
+    ax.autoscale_view()
+    ax.set_xlim([min(job.inputs), max(job.inputs)])
+    filename = job.name if format is None else "{}.{}".format(job.name, format)
+    if not directory is None:
+      filename = os.path.join(directory, filename)
+    fig.savefig(filename, format=format, dpi=dpi)
+    filenames.append(filename)
+  return filenames
+
+def plot_images(jobs, format = "png", dpi = None, directory = None, processes = None):
+  jobs = list(jobs)
+  if not processes or len(jobs) <= 1:
+    return _renderPlotJobs(jobs, format, dpi, directory)
+  from concurrent.futures import ProcessPoolExecutor
+  chunks = [ jobs[i::processes] for i in range(processes) ]
+  with ProcessPoolExecutor(processes) as executor:
+    results = list(executor.map(_renderPlotJobs, chunks, [format]*processes, [dpi]*processes, [directory]*processes))
+  # restore the order of the jobs
+  filenames = [None]*len(jobs)
+  for i in range(processes):
+    filenames[i::processes] = results[i]
+  return filenames
+
+def evaluateConcurrently(functions, threads = None):
+  # Evaluates independent calculations (functions without arguments) in a thread pool and returns their results in order.
+  # Since the conversions between arrays and density dictionaries hold the GIL this only runs in parallel on free-threaded Python builds.
+  functions = list(functions)
+  if threads == 1 or len(functions) <= 1:
+    return [ f() for f in functions ]
+  from concurrent.futures import ThreadPoolExecutor
+  with ThreadPoolExecutor(threads) as executor:
+    return list(executor.map(lambda f: f(), functions))
+
+# Additions of integer densities with at least _minConvolutionSize pairs of outcomes are convolutions,
+# unless the dense arrays would have more than _maxConvolutionSparsity times as many pairs
+_minConvolutionSize = 64
+_maxConvolutionSparsity = 4
 
 class Density:
+  # print(density) bins the plot to at most maxPlotRows rows (None: one row per result)
+  maxPlotRows = 500
+
   def __init__(self, densities):
     self._cdfList = None
+    self._arrays = None
     if isinstance(densities, dict):
       self.densities = densities
     else:
@@ -196,12 +602,16 @@ class Density:
     s += "{:>12}\t{:>12.5f}".format("Stdev", self.stdev()) + "\n"
     s += "\n"
     s += "{:>12}\t{:>12}\t{}".format("Result", "Probability", "Plot") + "\n"
-    s += self.plot(50)
+    s += self.plot(50, maxRows=Density.maxPlotRows)
     return s
 
   def __repr__(self):
     return self.__str__()
 
+  def __getstate__(self):
+    # memoized methods are stored on the instance and can't be pickled
+    return { k: v for k, v in self.__dict__.items() if not callable(v) }
+
   def _state(self):
     keys = self.keys()
     return tuple(map(lambda k: (k, self.densities[k]), keys))
@@ -221,6 +631,8 @@ class Density:
 
     if isinstance(arg, Density):
       return arg
+    elif isinstance(arg, LazyDensity):
+      return arg.materialize()
     else:
       raise ValueError("arg must be a Density or a number!")
 
@@ -234,6 +646,21 @@ class Density:
   def values(self):
     return [ self.densities[k] for k in self.keys() ]
 
+  def _getArrays(self):
+    # Lazily filled caches are built completely before they're published with a single assignment,
+    # so concurrent readers either see nothing (and calculate it themselves) or the final result.
+    arrays = self._arrays
+    if arrays is None:
+      keys = self.keys()
+      arrays = (np.array(keys), np.array([self.densities[k] for k in keys], dtype=float))
+      for a in arrays:
+        a.flags.writeable = False
+      self._arrays = arrays
+    return arrays
+
+  def lazy(self):
+    return _LazyLeaf(self)
+
   def isValid(self):
     return abs(1.0 - sum(self.values())) < 1e-09
 
@@ -277,13 +704,65 @@ class Density:
         resDensity[resKey] += 1.0*self.densities[sKey]*otherDensity.densities[oKey]
     return Density(resDensity)
 
+  def _convolve(self, other):
+    # Sum of two densities with (dense) integer supports as one numpy convolution (which releases the GIL),
+    # None if the supports are too small or too sparse for it
+    sKeys, sProbs = self._getArrays()
+    oKeys, oProbs = other._getArrays()
+    if sKeys.dtype.kind != 'i' or oKeys.dtype.kind != 'i' or sKeys.ndim != 1 or oKeys.ndim != 1 or len(sKeys)*len(oKeys) < _minConvolutionSize:
+      return None
+    sSpan = int(sKeys[-1] - sKeys[0]) + 1
+    oSpan = int(oKeys[-1] - oKeys[0]) + 1
+    if sSpan*oSpan > _maxConvolutionSparsity*len(sKeys)*len(oKeys):
+      return None
+    sDense = np.zeros(sSpan)
+    sDense[sKeys - sKeys[0]] = sProbs
+    oDense = np.zeros(oSpan)
+    oDense[oKeys - oKeys[0]] = oProbs
+    probs = np.convolve(sDense, oDense)
+    indices = np.flatnonzero(probs)
+    return Density(dict(zip((indices + int(sKeys[0] + oKeys[0])).tolist(), probs[indices].tolist())))
+
+  def _constantValue(self):
+    if len(self.densities) == 1:
+      return next(iter(self.densities))
+    return None
+
+  def shift(self, c):
+    return Density({ k + c: p for k, p in self.densities.items() })
+
+  def scale(self, c):
+    if c == 0:
+      return self.op(lambda k: 0)
+    return Density({ k * c: p for k, p in self.densities.items() })
+
   def __add__(self, other):
+    if isinstance(other, LazyDensity):
+      return NotImplemented
+    if isinstance(other, (int, float)):
+      return self.shift(other)
+    if isinstance(other, Density) and other._constantValue() is not None:
+      return self.shift(other._constantValue())
+    if isinstance(other, Density) and self._constantValue() is not None:
+      return other.shift(self._constantValue())
+    if isinstance(other, Density):
+      res = self._convolve(other)
+      if not res is None:
+        return res
     return self.binOp(other, lambda a,b : a+b)
 
   def __sub__(self, other):
     return self + (-other)
 
   def __mul__(self, other):
+    if isinstance(other, LazyDensity):
+      return NotImplemented
+    if isinstance(other, (int, float)):
+      return self.scale(other)
+    if isinstance(other, Density) and other._constantValue() is not None:
+      return self.scale(other._constantValue())
+    if isinstance(other, Density) and self._constantValue() is not None:
+      return other.scale(self._constantValue())
     return self.binOp(other, lambda a,b: a*b)
 
   __radd__ = __add__
@@ -300,7 +779,7 @@ class Density:
     return Density(densities)
 
   def __neg__(self):
-    return self.op(lambda k: -k)
+    return self.scale(-1)
 
   def __abs__(self):
     return self.op(lambda k: abs(k))
@@ -315,21 +794,33 @@ class Density:
     return resSum
 
   def __eq__(self, y):
+    if isinstance(y, LazyDensity):
+      return NotImplemented
     return self.prob(y, lambda a,b: a == b)
 
   def __ne__(self, y):
+    if isinstance(y, LazyDensity):
+      return NotImplemented
     return self.prob(y, lambda a,b: a != b)
 
   def __lt__(self, y):
+    if isinstance(y, LazyDensity):
+      return NotImplemented
     return self.prob(y, lambda a,b: a < b)
 
   def __le__(self, y):
+    if isinstance(y, LazyDensity):
+      return NotImplemented
     return self.prob(y, lambda a,b: a <= b)
 
   def __gt__(self, y):
+    if isinstance(y, LazyDensity):
+      return NotImplemented
     return self.prob(y, lambda a,b: a > b)
 
   def __ge__(self, y):
+    if isinstance(y, LazyDensity):
+      return NotImplemented
     return self.prob(y, lambda a,b: a >= b)
 
   def __getitem__(self, key):
@@ -365,9 +856,12 @@ class Density:
     return self <= x;
 
   def _getCdfList(self):
-    if self._cdfList is None:
-      self._cdfList = [ [k,self.cdf(k)] for k in sorted(self.keys()) ]
-    return self._cdfList
+    # see _getArrays
+    cdfList = self._cdfList
+    if cdfList is None:
+      cdfList = [ [k,self.cdf(k)] for k in sorted(self.keys()) ]
+      self._cdfList = cdfList
+    return cdfList
 
   def inverseCdf(self, p):
     if p < 0.0 or p > 1.0:
@@ -394,12 +888,16 @@ class Density:
   def normalApproximation(self, x):
     return Density.gaussMap(self.expected(), self.stdev())(x)
 
-  def plot(self, plotWidth=70):
-    maxPerc = max(self.values())
-    return get_plot(lambda k: self.densities[k], self.keys(), plotWidth=plotWidth, minP=0.0, maxP=maxPerc, asPercentage=True)
+  def plot(self, plotWidth=70, maxRows=None, file=None):
+    # with maxRows the probabilities of consecutive results are summed up
+    return get_plot(lambda k: self.densities[k], self.keys(), plotWidth=plotWidth, minP=0.0, asPercentage=True, maxRows=maxRows, aggregate=sum, file=file)
 
   def plotImage(self, name="plot", fmt='-', **kwargs):
-    plot_image(lambda k: self.densities[k], self.keys(), name = name, xlabel = "Result", ylabel = "Probability", fmt='-', **kwargs)
+    plot_images([self.plotImageJob(name, fmt, **kwargs)], format = None)
+
+  def plotImageJob(self, name="plot", fmt='-', **kwargs):
+    keys, probs = self._getArrays()
+    return PlotJob(name, keys.tolist(), probs.tolist(), xlabel = "Result", ylabel = "Probability", fmt=fmt, **kwargs)
 
   def roll(self):
     r = random.random()
@@ -410,11 +908,48 @@ class Density:
         return k
     return self.keys()[-1]
 
-  def with_advantage(self):
-    return self.binOp(self, lambda a,b: max(a,b))
-
-  def with_disadvantage(self):
-    return self.binOp(self, lambda a,b: min(a,b))
+  def sample(self, size, rng=None):
+    if rng is None:
+      rng = np.random.default_rng()
+    keys, probs = self._getArrays()
+    cumulative = np.cumsum(probs)
+    indices = np.searchsorted(cumulative, rng.random(size)*cumulative[-1], side='right')
+    return keys[np.minimum(indices, len(keys) - 1)]
+
+  def with_advantage(self, rolls=2):
+    return maxDensity(*([self] * rolls))
+
+  def with_disadvantage(self, rolls=2):
+    return minDensity(*([self] * rolls))
+
+  def successCount(self, n, threshold, doubleThreshold=None):
+    # Number of successes when rolling n times, each roll >= threshold is a success,
+    # each roll >= doubleThreshold counts as an additional success
+    if doubleThreshold is None:
+      p = self >= threshold
+      q = self < threshold
+      if p <= 0.0:
+        return Constant(0)
+      if q <= 0.0:
+        return Constant(n)
+      logP = math.log(p)
+      logQ = math.log(q)
+      densities = {}
+      for k in range(n + 1):
+        logBinomial = math.lgamma(n + 1) - math.lgamma(k + 1) - math.lgamma(n - k + 1)
+        densities[k] = math.exp(logBinomial + k*logP + (n - k)*logQ)
+      return Density(densities)
+
+    lower = min(threshold, doubleThreshold)
+    upper = max(threshold, doubleThreshold)
+    perRoll = np.array([self < lower, (self >= lower) - (self >= upper), self >= upper])
+    res = np.array([1.0])
+    while n > 0:
+      if n & 1:
+        res = np.convolve(res, perRoll)
+      perRoll = np.convolve(perRoll, perRoll)
+      n >>= 1
+    return Density({ k: p for k, p in enumerate(res.tolist()) if p > 0 })
 
   def summedDensity(self, goal):
     if min(self.keys()) <= 0:
@@ -461,11 +996,70 @@ class One(Constant):
   def __init__(self):
     Constant.__init__(self, 1)
 
-def AdvantageDie(die):
-  return Die(die).with_advantage()
-
-def DisadvantageDie(die):
-  return Die(die).with_disadvantage()
+def AdvantageDie(die, rolls=2):
+  return Die(die).with_advantage(rolls)
+
+def DisadvantageDie(die, rolls=2):
+  return Die(die).with_disadvantage(rolls)
+
+def _sameScalarKeys(densities, arrays):
+  # True if the outcomes of all densities are numeric scalars of one dtype (numpy would flatten tuples and turn mixed ints into floats)
+  dtypes = set([ keys.dtype for (keys, probs) in arrays ])
+  if len(dtypes) != 1 or any([ keys.ndim != 1 for (keys, probs) in arrays ]):
+    return False
+  kind = next(iter(dtypes)).kind
+  if kind == 'f':
+    return all([ type(k) is float for d in densities for k in d.keys() ])
+  return kind in 'iu'
+
+def mixture(densities, weights):
+  # All components are accumulated in one pass over the concatenated outcome/probability arrays
+  densities = [ Density._getDensity(d) for d in densities ]
+  arrays = [ d._getArrays() for d in densities ]
+  if not _sameScalarKeys(densities, arrays):
+    resDensity = {}
+    for density, w in zip(densities, weights):
+      for resKey in density.keys():
+        if resKey not in resDensity:
+          resDensity[resKey] = 0.0
+        resDensity[resKey] += density[resKey] * w
+    return Density(resDensity)
+  keys, inverse = np.unique(np.concatenate([ keys for (keys, probs) in arrays ]), return_inverse=True)
+  probs = np.concatenate([ probs * w for (keys, probs), w in zip(arrays, weights) ])
+  return Density(dict(zip(keys.tolist(), np.bincount(inverse.ravel(), weights=probs, minlength=len(keys)).tolist())))
+
+def _unionKeys(arrays):
+  return np.unique(np.concatenate([ keys for (keys, probs) in arrays ]))
+
+def maxDensity(*densities):
+  # For independent densities P(max <= k) is the product of all P(d <= k)
+  densities = [ Density._getDensity(d) for d in densities ]
+  arrays = [ d._getArrays() for d in densities ]
+  if not _sameScalarKeys(densities, arrays):
+    return reduce(lambda a, b: a.binOp(b, max), densities)
+  keys = _unionKeys(arrays)
+  cdf = np.ones(len(keys))
+  for dKeys, dProbs in arrays:
+    below = np.concatenate(([0.0], np.cumsum(dProbs)))
+    cdf *= below[np.searchsorted(dKeys, keys, side='right')]
+  probs = np.diff(cdf, prepend=0.0)
+  mask = probs > 0
+  return Density(dict(zip(keys[mask].tolist(), probs[mask].tolist())))
+
+def minDensity(*densities):
+  # For independent densities P(min >= k) is the product of all P(d >= k)
+  densities = [ Density._getDensity(d) for d in densities ]
+  arrays = [ d._getArrays() for d in densities ]
+  if not _sameScalarKeys(densities, arrays):
+    return reduce(lambda a, b: a.binOp(b, min), densities)
+  keys = _unionKeys(arrays)
+  survival = np.ones(len(keys))
+  for dKeys, dProbs in arrays:
+    above = np.concatenate((np.cumsum(dProbs[::-1])[::-1], [0.0]))
+    survival *= above[np.searchsorted(dKeys, keys, side='left')]
+  probs = -np.diff(survival, append=0.0)
+  mask = probs > 0
+  return Density(dict(zip(keys[mask].tolist(), probs[mask].tolist())))
 
 
 class MultiDensity(Density):
@@ -473,7 +1067,16 @@ class MultiDensity(Density):
     self.densityList = dList
     Density.__init__(self, sum(self.densityList).densities)
 
-  def multiOp(self, opr):
+  def productSize(self):
+    return reduce(op.mul, [ len(d.keys()) for d in self.densityList ], 1)
+
+  def cost(self):
+    productSize = self.productSize()
+    return CostEstimate(productSize, productSize*len(self.densityList), productSize)
+
+  def multiOp(self, opr, budget=None):
+    if not budget is None:
+      budget.check(self.cost(), "multiOp")
     dList = map(lambda k: map(lambda l: [l, k.densities[l]], k.densities.keys()), self.densityList)
     resDensity = {}
     for p in product(*dList):
@@ -484,48 +1087,590 @@ class MultiDensity(Density):
       resDensity[resKey] += summand
     return Density(resDensity)
 
+  def vectorizedMultiOp(self, opr, chunkSize=2**20, budget=None):
+    # opr is called with numpy arrays of outcomes (one per density), at most chunkSize combinations at a time
+    if not budget is None:
+      # numpy needs far less time per combination than the dict based multiOp
+      productSize = self.productSize()
+      budget.check(CostEstimate(productSize, productSize*len(self.densityList)//10, productSize), "vectorizedMultiOp")
+    arrays = [ d._getArrays() for d in self.densityList ]
+    shape = tuple([ len(keys) for (keys, probs) in arrays ])
+    total = reduce(op.mul, shape, 1)
+    resKeys = []
+    resProbs = []
+    for start in range(0, total, chunkSize):
+      indices = np.unravel_index(np.arange(start, min(start + chunkSize, total)), shape)
+      outcomes = [ keys[i] for (keys, probs), i in zip(arrays, indices) ]
+      probs = reduce(op.mul, [ probs[i] for (keys, probs), i in zip(arrays, indices) ])
+      results = np.broadcast_to(np.asarray(opr(*outcomes)), probs.shape)
+      chunkKeys, inverse = np.unique(results, return_inverse=True)
+      resKeys.append(chunkKeys)
+      resProbs.append(np.bincount(inverse.ravel(), weights=probs, minlength=len(chunkKeys)))
+    keys, inverse = np.unique(np.concatenate(resKeys), return_inverse=True)
+    probs = np.bincount(inverse.ravel(), weights=np.concatenate(resProbs), minlength=len(keys))
+    return Density(dict(zip(keys.tolist(), probs.tolist())))
+
+  def _sortedSlice(self, start, stop):
+    n = len(self.densityList)
+    start = min(max(start, 0), n)
+    stop = min(max(stop, 0), n)
+    if stop - start == 1 and stop == n:
+      return maxDensity(*self.densityList)
+    if stop - start == 1 and start == 0:
+      return minDensity(*self.densityList)
+    densities = [ Density._getDensity(d) for d in self.densityList ]
+    if not _sameScalarKeys(densities, [ d._getArrays() for d in densities ]):
+      # numpy can't sort and sum e.g. tuples, so the outcomes are sorted per combination
+      return self.multiOp(lambda *a: sum(sorted(a)[start:stop]))
+    return self.vectorizedMultiOp(lambda *a: np.sort(np.stack(a), axis=0)[start:stop].sum(axis=0))
+
   def drop_highest(self, n=1):
-    if n == 1:
-      return self.multiOp(lambda *a: sum(a)-max(a))
-    else:
-      return self.multiOp(lambda *a: sum(a)-sum(heapq.nlargest(n,a)))
+    return self._sortedSlice(0, len(self.densityList) - n)
 
   def drop_lowest(self, n=1):
-    if n == 1:
-      return self.multiOp(lambda *a: sum(a)-min(a))
-    else:
-      return self.multiOp(lambda *a: sum(a)-sum(heapq.nsmallest(n,a)))
+    return self._sortedSlice(n, len(self.densityList))
 
   def keep_highest(self, n=1):
-    if n == 1:
-      return self.multiOp(lambda *a: max(a))
-    else:
-      return self.multiOp(lambda *a: sum(heapq.nlargest(n,a)))
+    return self._sortedSlice(len(self.densityList) - n, len(self.densityList))
 
   def keep_lowest(self, n=1):
-    if n == 1:
-      return self.multiOp(lambda *a: min(a))
-    else:
-      return self.multiOp(lambda *a: sum(heapq.nsmallest(n,a)))
+    return self._sortedSlice(0, n)
 
   def combine(self, *pList):
     if len(pList) != len(self.densityList):
       raise ValueError("The number of probabilities does not match the number of internal densities!") 
     if abs(1.0 - sum(pList)) >= 1e-09:
       raise ValueError("The list of probabilities must add up to 1.0!") 
-    resDensity = {}
-    for i in range(0, len(self.densityList)):
-      density = self.densityList[i]
-      for resKey in density.keys():
-        if resKey not in resDensity:
-          resDensity[resKey] = 0.0
-        resDensity[resKey] += density[resKey] * pList[i]
-    return Density(resDensity)
+    return mixture(self.densityList, pList)
 
   def keepRandom(self):
     n = len(self.densityList)
     return self.combine(*list([1.0/n]*n))
 
+def _asLazy(arg):
+  if isinstance(arg, LazyDensity):
+    return arg
+  if isinstance(arg, (int, float)):
+    return _LazyLeaf(Constant(arg))
+  if isinstance(arg, Density):
+    return _LazyLeaf(arg)
+  raise ValueError("arg must be a Density, a LazyDensity or a number!")
+
+
+def _normalTail(z):
+  return 0.5*math.erfc(z/math.sqrt(2))
+
+def _normalDensity(z):
+  return math.exp(-z*z/2)/math.sqrt(2*math.pi)
+
+class _Cgf:
+  # Cumulant generating function K(s) of shift + the sum of count independent copies of
+  # coefficient*density for every term (density, coefficient, count) (see LazyDensity._linearTerms)
+  def __init__(self, terms, shift):
+    self.shift = shift
+    self.terms = []
+    self.lower = shift
+    self.upper = shift
+    # sums of (rational multiples of) integer outcomes only take values lower + k*span (span 0: no lattice)
+    span = Fraction(0)
+    isLattice = True
+    for density, coefficient, count in terms:
+      keys, probs = density._getArrays()
+      values = keys*coefficient
+      self.terms.append((values.astype(float), probs/probs.sum(), count))
+      self.lower += count*values.min().item()
+      self.upper += count*values.max().item()
+      if len(keys) > 1:
+        factor = Fraction(coefficient).limit_denominator(10**6)
+        if keys.dtype.kind == 'i' and keys.ndim == 1 and factor == coefficient:
+          termSpan = abs(int(np.gcd.reduce(np.diff(keys)))*factor)
+          span = Fraction(math.gcd(span.numerator*termSpan.denominator, termSpan.numerator*span.denominator), span.denominator*termSpan.denominator)
+        else:
+          isLattice = False
+    self.span = (int(span) if span.denominator == 1 else float(span)) if isLattice else 0
+
+  def negated(self):
+    res = _Cgf([], -self.shift)
+    res.terms = [ (-values, probs, count) for (values, probs, count) in self.terms ]
+    (res.span, res.lower, res.upper) = (self.span, -self.upper, -self.lower)
+    return res
+
+  def derivatives(self, s):
+    # K(s) and its first four derivatives, calculated from the exponentially tilted terms
+    res = [s*self.shift, self.shift, 0.0, 0.0, 0.0]
+    for values, probs, count in self.terms:
+      exponents = s*values
+      maxExponent = exponents.max()
+      weights = probs*np.exp(exponents - maxExponent)
+      total = weights.sum()
+      weights /= total
+      mean = np.dot(weights, values)
+      centered = values - mean
+      squared = centered*centered
+      m2 = np.dot(weights, squared)
+      res[0] += count*(maxExponent + math.log(total))
+      res[1] += count*mean
+      res[2] += count*m2
+      res[3] += count*np.dot(weights, squared*centered)
+      res[4] += count*(np.dot(weights, squared*squared) - 3*m2*m2)
+    return [ float(r) for r in res ]
+
+  def cumulants(self):
+    return self.derivatives(0.0)[1:]
+
+  def saddlepoint(self, x):
+    # Solves K'(s) = x (Newton steps, bisection whenever a step leaves the bracket)
+    (lower, upper) = (-math.inf, math.inf)
+    s = 0.0
+    for i in range(200):
+      (k, k1, k2, k3, k4) = self.derivatives(s)
+      diff = k1 - x
+      if abs(diff) <= 1e-12*max(1.0, abs(x)):
+        break
+      if diff > 0:
+        upper = s
+      else:
+        lower = s
+      step = s - diff/k2 if k2 > 0 else math.nan
+      if not lower < step < upper:
+        if math.isinf(lower) or math.isinf(upper):
+          step = s + (1.0 + 2*abs(s))*(1 if diff < 0 else -1)
+        else:
+          step = (lower + upper)/2
+      s = step
+    return s
+
+  def _edgeworthTail(self, x):
+    (k1, k2, k3, k4) = self.cumulants()
+    z = (x - k1)/math.sqrt(k2)
+    (g1, g2) = (k3/k2**1.5, k4/k2**2)
+    firstOrder = g1/6*(z*z - 1)
+    secondOrder = g2/24*(z**3 - 3*z) + g1*g1/72*(z**5 - 10*z**3 + 15*z)
+    p = _normalTail(z) + _normalDensity(z)*(firstOrder + secondOrder)
+    return (min(1.0, max(0.0, p)), _normalDensity(z)*abs(secondOrder))
+
+  def tail(self, x, method = "saddlepoint"):
+    # (P(X >= x), error estimate), Lugannani-Rice with the second continuity correction on lattices.
+    # The error estimate is the size of the next term of the expansion.
+    if self.lower == self.upper:
+      return (1.0 if x <= self.lower else 0.0, 0.0)
+    if self.span:
+      x = self.lower + math.ceil((x - self.lower)/self.span - 1e-9)*self.span
+    if x <= self.lower:
+      return (1.0, 0.0)
+    if x > self.upper or (not self.span and x >= self.upper):
+      return (0.0, 0.0)
+    x -= self.span/2
+    if method == "edgeworth":
+      return self._edgeworthTail(x)
+    s = self.saddlepoint(x)
+    (k, k1, k2, k3, k4) = self.derivatives(s)
+    w = math.copysign(math.sqrt(max(0.0, 2*(s*x - k))), s)
+    if abs(w) < 0.1:
+      # close to the mean the expansion is numerically unstable (but the Edgeworth expansion is accurate there)
+      return self._edgeworthTail(x)
+    if self.span:
+      u = math.copysign(2*math.sinh(min(700.0, abs(s)*self.span/2))/self.span, s)*math.sqrt(k2)
+    else:
+      u = s*math.sqrt(k2)
+    (l3, l4) = (k3/k2**1.5, k4/k2**2)
+    p = _normalTail(w) + _normalDensity(w)*(1/u - 1/w)
+    error = _normalDensity(w)*abs((l4/8 - 5*l3*l3/24)/u - 1/u**3 - l3/(2*u*u) + 1/w**3)
+    return (min(1.0, max(0.0, p)), error)
+
+  def cdf(self, x, method = "saddlepoint"):
+    # P(X <= x) = P(-X >= -x), which is accurate in the lower tail as well
+    return self.negated().tail(-x, method)
+
+  def quantile(self, p, method = "saddlepoint"):
+    # smallest x with P(X <= x) >= p
+    cdf = self.negated()
+    if self.span:
+      (lower, upper) = (0, int(round((self.upper - self.lower)/self.span)))
+      while lower < upper:
+        middle = (lower + upper)//2
+        if cdf.tail(-(self.lower + middle*self.span), method)[0] >= p:
+          upper = middle
+        else:
+          lower = middle + 1
+      return self.lower + lower*self.span
+    (lower, upper) = (self.lower, self.upper)
+    for i in range(100):
+      middle = (lower + upper)/2
+      if cdf.tail(-middle, method)[0] >= p:
+        upper = middle
+      else:
+        lower = middle
+    return upper
+
+
+class LazyDensity:
+  # The approximate* methods calculate exact results if the support has at most exactSupportLimit outcomes
+  exactSupportLimit = 10000
+
+  def __init__(self):
+    self._density = None
+    self._cgf = None
+
+  def __str__(self):
+    return str(self.materialize())
+
+  def __repr__(self):
+    return self.__str__()
+
+  def __hash__(self):
+    return hash(self.materialize())
+
+  def __getattr__(self, name):
+    # Everything without a lazy implementation is answered by the materialized density
+    if name.startswith('_'):
+      raise AttributeError(name)
+    return getattr(self.materialize(), name)
+
+  def materialize(self):
+    # see Density._getArrays
+    density = self._density
+    if density is None:
+      density = self._materialize()
+      self._density = density
+    return density
+
+  def lazy(self):
+    return self
+
+  def _constantValue(self):
+    return None
+
+  def _supportEstimate(self):
+    return len(self.materialize().densities)
+
+  def expected(self):
+    return self.materialize().expected()
+
+  def variance(self):
+    return self.materialize().variance()
+
+  def stdev(self):
+    return math.sqrt(self.variance())
+
+  def normalApproximation(self, x):
+    return Density.gaussMap(self.expected(), self.stdev())(x)
+
+  def _linearTerms(self):
+    # (terms, shift) such that self is shift + the sum of count independent copies of
+    # coefficient*density for every (density, coefficient, count) in terms
+    if self._constantValue() is not None:
+      return ([], self._constantValue())
+    return ([(self.materialize(), 1, 1)], 0)
+
+  def _getCgf(self):
+    # see Density._getArrays
+    cgf = self._cgf
+    if cgf is None:
+      terms, shift = self._linearTerms()
+      # identical terms (e.g. d20 + d20) are combined
+      counts = {}
+      for density, coefficient, count in terms:
+        key = (id(density), coefficient)
+        counts[key] = (density, coefficient, counts[key][2] + count if key in counts else count)
+      cgf = _Cgf(list(counts.values()), shift)
+      self._cgf = cgf
+    return cgf
+
+  def cumulants(self):
+    # [mean, variance, third and fourth cumulant], calculated from the summands
+    return self._getCgf().cumulants()
+
+  def _isSmall(self, method):
+    if not method in ("saddlepoint", "edgeworth", "exact"):
+      raise ValueError("method must be saddlepoint, edgeworth or exact!")
+    return method == "exact" or self._supportEstimate() <= LazyDensity.exactSupportLimit
+
+  def approximateTail(self, x, includeError = False, method = "saddlepoint"):
+    # P(self >= x)
+    res = (self >= x, 0.0) if self._isSmall(method) else self._getCgf().tail(x, method)
+    return res if includeError else res[0]
+
+  def approximateCdf(self, x, includeError = False, method = "saddlepoint"):
+    # P(self <= x)
+    res = (self <= x, 0.0) if self._isSmall(method) else self._getCgf().cdf(x, method)
+    return res if includeError else res[0]
+
+  def approximateQuantile(self, p, includeError = False, method = "saddlepoint"):
+    if p < 0.0 or p > 1.0:
+      raise ValueError("Argument must be a probability (0<=p<=1)!")
+    if self._isSmall(method):
+      x = self.materialize().inverseCdf(p)
+      return (x, 0.0) if includeError else x
+    cgf = self._getCgf()
+    x = cgf.quantile(p, method)
+    if not includeError:
+      return x
+    # the error estimate of the cdf translated to outcomes
+    error = cgf.cdf(x, method)[1]
+    lower = cgf.quantile(max(0.0, p - error), method)
+    upper = cgf.quantile(min(1.0, p + error), method)
+    return (x, max(x - lower, upper - x))
+
+  def __add__(self, other):
+    return _LazySum([self, other])
+
+  def __sub__(self, other):
+    return self + (-_asLazy(other))
+
+  def __rsub__(self, other):
+    return _asLazy(other) + (-self)
+
+  def __mul__(self, other):
+    other = _asLazy(other)
+    if other._constantValue() is not None:
+      return _LazyScale(self, other._constantValue())
+    if self._constantValue() is not None:
+      return _LazyScale(other, self._constantValue())
+    return _LazyProduct(self, other)
+
+  __radd__ = __add__
+  __rmul__ = __mul__
+
+  def __neg__(self):
+    return _LazyNeg(self)
+
+  def __abs__(self):
+    return self.op(lambda k: abs(k))
+
+  def op(self, opr):
+    return _LazyOp(self, opr)
+
+  def arithMult(self, other):
+    if isinstance(other, (int)) and other >= 0:
+      if other == 0:
+        return Zero().lazy()
+      if other == 1:
+        return self
+      return _LazyMult(self, other)
+    return self.materialize().arithMult(other)
+
+  def _probAgainstZero(self, cond):
+    return float(_thresholdProbabilities(self.materialize(), np.array([0]), cond)[0])
+
+  def _compare(self, other, cond):
+    return (self - other)._probAgainstZero(cond)
+
+  def __eq__(self, y):
+    return self._compare(y, op.eq)
+
+  def __ne__(self, y):
+    return self._compare(y, op.ne)
+
+  def __lt__(self, y):
+    return self._compare(y, op.lt)
+
+  def __le__(self, y):
+    return self._compare(y, op.le)
+
+  def __gt__(self, y):
+    return self._compare(y, op.gt)
+
+  def __ge__(self, y):
+    return self._compare(y, op.ge)
+
+  def cdf(self, x):
+    return self <= x
+
+
+class _LazyLeaf(LazyDensity):
+  def __init__(self, density):
+    LazyDensity.__init__(self)
+    self._density = density
+
+  def _materialize(self):
+    return self._density
+
+  def _constantValue(self):
+    if len(self._density.densities) == 1:
+      return next(iter(self._density.densities))
+    return None
+
+  def expected(self):
+    return self._density.expected()
+
+  def variance(self):
+    return self._density.variance()
+
+  def __neg__(self):
+    if self._constantValue() is not None:
+      return Constant(-self._constantValue()).lazy()
+    return _LazyNeg(self)
+
+
+class _LazySum(LazyDensity):
+  def __init__(self, args, shift=0):
+    LazyDensity.__init__(self)
+    self.terms = []
+    self.shift = shift
+    for arg in args:
+      node = _asLazy(arg)
+      if isinstance(node, _LazySum):
+        self.terms.extend(node.terms)
+        self.shift += node.shift
+      elif node._constantValue() is not None:
+        self.shift += node._constantValue()
+      else:
+        self.terms.append(node)
+
+  def _materialize(self):
+    if not self.terms:
+      return Constant(self.shift)
+    res = self.terms[0].materialize()
+    for term in self.terms[1:]:
+      res = res + term.materialize()
+    if self.shift != 0:
+      res = res + self.shift
+    return res
+
+  def _constantValue(self):
+    if not self.terms:
+      return self.shift
+    return None
+
+  def _supportEstimate(self):
+    return sum([term._supportEstimate() - 1 for term in self.terms]) + 1
+
+  def expected(self):
+    return sum([term.expected() for term in self.terms]) + self.shift
+
+  def variance(self):
+    return sum([term.variance() for term in self.terms])
+
+  def __neg__(self):
+    return _LazySum([-term for term in self.terms], -self.shift)
+
+  def _linearTerms(self):
+    terms = []
+    shift = self.shift
+    for term in self.terms:
+      termTerms, termShift = term._linearTerms()
+      terms.extend(termTerms)
+      shift += termShift
+    return (terms, shift)
+
+  def _probAgainstZero(self, cond):
+    # Fuse the comparison with the last convolution: the term with the largest support
+    # is never added, its cdf is evaluated at every outcome of the remaining sum instead.
+    if not self.terms:
+      return 1.0 if cond(self.shift, 0) else 0.0
+    supports = [term._supportEstimate() for term in self.terms]
+    lastIndex = supports.index(max(supports))
+    rest = _LazySum(self.terms[:lastIndex] + self.terms[lastIndex+1:], self.shift).materialize()
+    keys, probs = rest._getArrays()
+    return float(np.dot(probs, _thresholdProbabilities(self.terms[lastIndex].materialize(), -keys, cond)))
+
+
+class _LazyNeg(LazyDensity):
+  def __init__(self, child):
+    LazyDensity.__init__(self)
+    self.child = child
+
+  def _materialize(self):
+    return -self.child.materialize()
+
+  def _supportEstimate(self):
+    return self.child._supportEstimate()
+
+  def expected(self):
+    return -self.child.expected()
+
+  def variance(self):
+    return self.child.variance()
+
+  def _linearTerms(self):
+    terms, shift = self.child._linearTerms()
+    return ([ (density, -coefficient, count) for (density, coefficient, count) in terms ], -shift)
+
+  def __neg__(self):
+    return self.child
+
+
+class _LazyMult(LazyDensity):
+  def __init__(self, child, n):
+    LazyDensity.__init__(self)
+    self.child = child
+    self.n = n
+
+  def _materialize(self):
+    return self.child.materialize().arithMult(self.n)
+
+  def _supportEstimate(self):
+    return self.n*(self.child._supportEstimate() - 1) + 1
+
+  def expected(self):
+    return self.n*self.child.expected()
+
+  def variance(self):
+    return self.n*self.child.variance()
+
+  def _linearTerms(self):
+    terms, shift = self.child._linearTerms()
+    return ([ (density, coefficient, self.n*count) for (density, coefficient, count) in terms ], self.n*shift)
+
+
+class _LazyScale(LazyDensity):
+  def __init__(self, child, factor):
+    LazyDensity.__init__(self)
+    self.child = child
+    self.factor = factor
+
+  def _materialize(self):
+    return self.child.materialize() * self.factor
+
+  def _supportEstimate(self):
+    return self.child._supportEstimate()
+
+  def expected(self):
+    return self.factor*self.child.expected()
+
+  def variance(self):
+    return self.factor**2*self.child.variance()
+
+  def _linearTerms(self):
+    terms, shift = self.child._linearTerms()
+    return ([ (density, self.factor*coefficient, count) for (density, coefficient, count) in terms ], self.factor*shift)
+
+
+class _LazyProduct(LazyDensity):
+  def __init__(self, left, right):
+    LazyDensity.__init__(self)
+    self.left = left
+    self.right = right
+
+  def _materialize(self):
+    return self.left.materialize() * self.right.materialize()
+
+  def _supportEstimate(self):
+    return self.left._supportEstimate()*self.right._supportEstimate()
+
+  def expected(self):
+    return self.left.expected()*self.right.expected()
+
+  def variance(self):
+    leftSecond = self.left.variance() + self.left.expected()**2
+    rightSecond = self.right.variance() + self.right.expected()**2
+    return leftSecond*rightSecond - (self.left.expected()*self.right.expected())**2
+
+
+class _LazyOp(LazyDensity):
+  def __init__(self, child, opr):
+    LazyDensity.__init__(self)
+    self.child = child
+    self.opr = opr
+
+  def _materialize(self):
+    return self.child.materialize().op(self.opr)
+
+  def _supportEstimate(self):
+    return self.child._supportEstimate()
+
+
 d2   = Die(2)
 d3   = Die(3)
 d4   = Die(4)
@@ -537,9 +1682,9 @@ d20  = Die(20)
 d100 = Die(100)
 ad20 = AdvantageDie(20)
 dd20 = DisadvantageDie(20)
-#aad20 = d20.asMultiDensity(3).drop_lowest(2)
-#ddd20 = d20.asMultiDensity(3).drop_highest(2)
-#ad100 = AdvantageDie(100)
-#dd100 = DisadvantageDie(100)
-#aad100 = d100.asMultiDensity(3).drop_lowest(2)
-#ddd100 = d100.asMultiDensity(3).drop_highest(2)
+aad20 = AdvantageDie(20, 3)
+ddd20 = DisadvantageDie(20, 3)
+ad100 = AdvantageDie(100)
+dd100 = DisadvantageDie(100)
+aad100 = AdvantageDie(100, 3)
+ddd100 = DisadvantageDie(100, 3)
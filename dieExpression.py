@@ -8,8 +8,10 @@ if len(sys.argv) == 1:
   msg += "Supported density operators (resulting in a density): +, -, *, abs()\n"
   msg += "Supported comparison operators (resulting in a probability): <, >, <=, >=, ==, !=\n"
   msg += "Syntax for densities: d<number> (normal die), ad<number> (advantage die), dd<number> (disadvantage die), <number> (constant density)\n"
+  msg += "Remark: aad20 corresponds to rolling 3 d20 and keeping the highest, ddd20 to rolling 3 d20 and keeping the lowest (and so on)\n"
+  msg += "Syntax for dice pools: p<number>d<number>s<threshold> (number of rolls >= threshold), p<number>d<number>s<threshold>s<threshold> (rolls >= the second threshold count twice)\n"
   msg += "Remark: 3*d20 corresponds to one d20 who's result is multiplied by 3, m3d20 corresponds to d20+d20+d20\n\n"
-  msg += "Example: d20 + d6, d20 + d6 == 7, ad20-d6"
+  msg += "Example: d20 + d6, d20 + d6 == 7, ad20-d6, p10d10s8 >= 3"
   print(msg)
 else:
   arguments = str.join("", sys.argv[1:])
@@ -0,0 +1,296 @@
+from combatant import *
+import json
+
+# Member fields which change during the combat (the other fields are the same for all members of a kind)
+_memberFields = ("hp", "fatigue", "fatigueState")
+
+# Targeting policies: policy(attacker, enemies) returns a dict {index: probability} of the attacked enemies.
+# Enemies which can't fight are part of the enemies list as well but are never targeted.
+# The enemies are in the canonical order of the state (sorted by (kind, hp, fatigue), kinds are numbered in the order they first appear),
+# not in the order they were passed in, e.g. targetFirst attacks the fighting enemy of the first kind with the lowest hp.
+def _fightingIndices(enemies):
+  return [i for i in range(len(enemies)) if enemies[i].canFight()]
+
+def _uniformTargets(indices):
+  if not indices:
+    return {}
+  return {i: 1.0/len(indices) for i in indices}
+
+def targetFirst(attacker, enemies):
+  indices = _fightingIndices(enemies)
+  return _uniformTargets(indices[:1])
+
+def targetRandom(attacker, enemies):
+  return _uniformTargets(_fightingIndices(enemies))
+
+def targetWeakest(attacker, enemies):
+  indices = _fightingIndices(enemies)
+  if not indices:
+    return {}
+  minHp = min([enemies[i].hp for i in indices])
+  return _uniformTargets([i for i in indices if enemies[i].hp == minHp])
+
+def targetStrongest(attacker, enemies):
+  indices = _fightingIndices(enemies)
+  if not indices:
+    return {}
+  maxHp = max([enemies[i].hp for i in indices])
+  return _uniformTargets([i for i in indices if enemies[i].hp == maxHp])
+
+
+class GroupCombat:
+  # A state is a pair of sides, each side is a sorted tuple of members (kindIndex, hp, fatigue).
+  # Identical combatants share the same kind, so exchangeable states collapse to the same canonical state.
+  def __init__(self, party, enemies, partyPolicy = targetFirst, enemyPolicy = targetFirst, chanceEnemiesStart = None, precise = True, pruneThreshold = 0.0):
+    self.precise = precise
+    self.pruneThreshold = pruneThreshold
+    self.policies = (partyPolicy, enemyPolicy)
+    self.kinds = ([], [])
+    sides = (self._members(0, party), self._members(1, enemies))
+    self.rounds = 0
+    self.winMass = 0.0
+    self.prunedMass = 0.0
+    self.statesPerRound = []
+    self.decided = {}
+    self.frontier = {}
+    self._combatantCache = {}
+    self._outcomeCache = {}
+    self._transitionCache = {}
+    self._targetCache = {}
+
+    d = {sides: 1.0}
+    if not chanceEnemiesStart is None:
+      dEnemies = self._applySideTurn(d, 1, chanceEnemiesStart)
+      d = {}
+      for state in dEnemies:
+        d[state] = chanceEnemiesStart*dEnemies[state]
+      try:
+        d[sides] += 1.0 - chanceEnemiesStart
+      except KeyError:
+        d[sides] = 1.0 - chanceEnemiesStart
+    self._setFrontier(self._canonicalDistribution(d))
+
+  @staticmethod
+  def _kindKey(combatant):
+    # The damage density itself is part of the key (different closures may share the same __qualname__)
+    return (json.dumps(CombatSolution._fingerprint(combatant)[:-1]), combatant._damageDensity)
+
+  def _members(self, side, combatants):
+    kinds = self.kinds[side]
+    keys = [GroupCombat._kindKey(kind) for kind in kinds]
+    members = []
+    for combatant in combatants:
+      key = GroupCombat._kindKey(combatant)
+      if not key in keys:
+        keys.append(key)
+        kinds.append(combatant)
+      members.append((keys.index(key), combatant.hp, combatant.fatigue))
+    return tuple(sorted(members))
+
+  def combatant(self, side, member):
+    try:
+      return self._combatantCache[(side, member)]
+    except KeyError:
+      kindIndex, hp, fatigue = member
+      combatant = self.kinds[side][kindIndex].clone()
+      combatant.hp = hp
+      combatant.fatigue = fatigue
+      self._combatantCache[(side, member)] = combatant
+      return combatant
+
+  def combatants(self, side, state):
+    return [self.combatant(side, member) for member in state[side]]
+
+  def _canFight(self, side, member):
+    kindIndex, hp, fatigue = member
+    maxFatigue = self.kinds[side][kindIndex].maxFatigue
+    return hp > 0 and (maxFatigue is None or fatigue < maxFatigue)
+
+  def _targets(self, side, attackerMember, enemyMembers):
+    key = (side, attackerMember, enemyMembers)
+    try:
+      return self._targetCache[key]
+    except KeyError:
+      attacker = self.combatant(side, attackerMember)
+      enemies = [self.combatant(1 - side, member) for member in enemyMembers]
+      targets = self.policies[side](attacker, enemies)
+      self._targetCache[key] = targets
+      return targets
+
+  def _dependencies(self, side, attackerMember, defenderMember):
+    # Values of the member fields the attacker's damage density depends on (see dependsOn), resp. all member fields if they aren't declared
+    damageDensity = self.kinds[side][attackerMember[0]]._damageDensity
+    attacker = self.combatant(side, attackerMember)
+    attackerFields = getattr(damageDensity, "attackerFields", _memberFields)
+    attackerValues = tuple([attacker.fatigueState() if field == "fatigueState" else getattr(attacker, field) for field in _memberFields if field in attackerFields])
+    if defenderMember is None:
+      return attackerValues
+    defender = self.combatant(1 - side, defenderMember)
+    defenderFields = getattr(damageDensity, "defenderFields", _memberFields)
+    defenderValues = tuple([defender.fatigueState() if field == "fatigueState" else getattr(defender, field) for field in _memberFields if field in defenderFields])
+    return (attackerValues, defenderValues)
+
+  def _outcomes(self, side, attackerMember, defenderMember):
+    # Returns {(damage, isHit): probability}, the damage density distribution only depends on the kinds and the declared dependencies
+    attacker = self.combatant(side, attackerMember)
+    key = (side, attackerMember[0], defenderMember[0], self._dependencies(side, attackerMember, defenderMember))
+    try:
+      return self._outcomeCache[key]
+    except KeyError:
+      dd = attacker.damageDensityDistribution(self.combatant(1 - side, defenderMember))
+      outcomes = {}
+      for damageDensity in dd:
+        isHit = not damageDensity.isZero()
+        if not isHit:
+          damages = {0: 1.0}
+        elif self.precise:
+          damages = damageDensity
+        else:
+          damages = {damageDensity.expected(): 1.0}
+        for damage in damages.keys():
+          try:
+            outcomes[(damage, isHit)] += dd[damageDensity]*damages[damage]
+          except KeyError:
+            outcomes[(damage, isHit)] = dd[damageDensity]*damages[damage]
+      self._outcomeCache[key] = outcomes
+      return outcomes
+
+  def _attackedMember(self, side, member, damage, isHit):
+    if not isHit:
+      return member
+    kindIndex, hp, fatigue = member
+    maxFatigue = self.kinds[side][kindIndex].maxFatigue
+    if not maxFatigue is None and fatigue < maxFatigue:
+      fatigue += 1
+    return (kindIndex, max(0, hp - damage), fatigue)
+
+  def _transitions(self, side, attackerMember, defenderMember):
+    # Returns {defenderMemberNew: probability}, outcomes leading to the same defender member are merged (e.g. all lethal damages)
+    key = (side, attackerMember[0], self._dependencies(side, attackerMember, None), defenderMember)
+    try:
+      return self._transitionCache[key]
+    except KeyError:
+      outcomes = self._outcomes(side, attackerMember, defenderMember)
+      transitions = {}
+      for (damage, isHit) in outcomes:
+        defenderMemberNew = self._attackedMember(1 - side, defenderMember, damage, isHit)
+        try:
+          transitions[defenderMemberNew] += outcomes[(damage, isHit)]
+        except KeyError:
+          transitions[defenderMemberNew] = outcomes[(damage, isHit)]
+      self._transitionCache[key] = transitions
+      return transitions
+
+  def _applyAttack(self, d, side, position):
+    dNew = {}
+    for state in d:
+      pState = d[state]
+      attackerMember = state[side][position]
+      targets = self._targets(side, attackerMember, state[1 - side]) if self._canFight(side, attackerMember) else {}
+      if not targets:
+        try:
+          dNew[state] += pState
+        except KeyError:
+          dNew[state] = pState
+        continue
+      defenders = list(state[1 - side])
+      for target in targets:
+        defenderMember = defenders[target]
+        transitions = self._transitions(side, attackerMember, defenderMember)
+        for defenderMemberNew in transitions:
+          defenders[target] = defenderMemberNew
+          # The attacked side doesn't act during this turn, so it can be canonicalized right away
+          if side == 0:
+            stateNew = (state[0], tuple(sorted(defenders)))
+          else:
+            stateNew = (tuple(sorted(defenders)), state[1])
+          pNew = pState*targets[target]*transitions[defenderMemberNew]
+          try:
+            dNew[stateNew] += pNew
+          except KeyError:
+            dNew[stateNew] = pNew
+        defenders[target] = defenderMember
+    return dNew
+
+  def _prune(self, d, weight = 1.0):
+    # Drops the undecided states with a (weighted) probability below pruneThreshold after every attack,
+    # otherwise the intermediate distributions of a turn can grow far beyond the number of states per round
+    if self.pruneThreshold <= 0.0:
+      return d
+    dNew = {}
+    for state in d:
+      pState = d[state]
+      if weight*pState < self.pruneThreshold and not self._sideCantFight(0, state) and not self._sideCantFight(1, state):
+        self.prunedMass += weight*pState
+      else:
+        dNew[state] = pState
+    return dNew
+
+  def _applySideTurn(self, d, side, weight = 1.0):
+    # Members keep their position during a turn, so they attack in the canonical order of the state at the start of the turn
+    if not d:
+      return d
+    for position in range(len(next(iter(d))[side])):
+      d = self._prune(self._applyAttack(d, side, position), weight)
+    return d
+
+  @staticmethod
+  def _canonicalDistribution(d):
+    dNew = {}
+    for (party, enemies) in d:
+      state = (tuple(sorted(party)), tuple(sorted(enemies)))
+      try:
+        dNew[state] += d[(party, enemies)]
+      except KeyError:
+        dNew[state] = d[(party, enemies)]
+    return dNew
+
+  def _sideCantFight(self, side, state):
+    return not any([self._canFight(side, member) for member in state[side]])
+
+  def _setFrontier(self, d):
+    self.frontier = {}
+    for state in d:
+      pState = d[state]
+      if self._sideCantFight(0, state) or self._sideCantFight(1, state):
+        if self._sideCantFight(1, state):
+          self.winMass += pState
+        try:
+          self.decided[state] += pState
+        except KeyError:
+          self.decided[state] = pState
+      elif pState < self.pruneThreshold:
+        self.prunedMass += pState
+      else:
+        self.frontier[state] = pState
+
+  def _applyAttackRound(self, d):
+    return self._canonicalDistribution(self._applySideTurn(self._applySideTurn(d, 0), 1))
+
+  def distribution(self):
+    # a snapshot, later calls of refine don't change it
+    d = dict(self.decided)
+    d.update(self.frontier)
+    return d
+
+  def undecidedProbability(self):
+    return sum(self.frontier.values())
+
+  def refine(self, maxError = 0.005, maxRounds = None):
+    while self.undecidedProbability() > maxError and (maxRounds is None or self.rounds < maxRounds):
+      self.statesPerRound.append(len(self.frontier))
+      self._setFrontier(self._applyAttackRound(self.frontier))
+      self.rounds += 1
+    return self
+
+  def winProbability(self, includeError = False):
+    p = self.winMass
+    up = self.undecidedProbability()
+    if includeError:
+      return (p + (up + self.prunedMass)*p/(1 - up - self.prunedMass), p, up + self.prunedMass)
+    return p + (up + self.prunedMass)*p/(1 - up - self.prunedMass)
+
+
+def groupWinProbability(party, enemies, partyPolicy = targetFirst, enemyPolicy = targetFirst, chanceEnemiesStart = None, precise = True, pruneThreshold = 0.0, maxError = 0.005, includeError = False):
+  combat = GroupCombat(party, enemies, partyPolicy, enemyPolicy, chanceEnemiesStart, precise, pruneThreshold)
+  return combat.refine(maxError).winProbability(includeError)
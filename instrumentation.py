@@ -0,0 +1,169 @@
+import densities
+from densities import Density, MultiDensity
+from combatant import Combatant
+from collections import Counter
+from functools import wraps
+import json
+import math
+import time
+
+# (owner, attribute, isStaticMethod) of all instrumented operations,
+# memoized methods (e.g. Density.arithMult) are recorded by densities._memoizedObserver instead
+_targets = [
+  (Density, "binOp", False),
+  (Density, "_convolve", False),
+  (Density, "shift", False),
+  (Density, "scale", False),
+  (Density, "op", False),
+  (Density, "prob", False),
+  (Density, "conditionalDensity", False),
+  (Density, "successCount", False),
+  (MultiDensity, "multiOp", False),
+  (MultiDensity, "vectorizedMultiOp", False),
+  (Combatant, "damageDensityDistribution", False),
+  (Combatant, "clone", False),
+  (Combatant, "_attackedCombatantDistribution", False),
+  (Combatant, "_adjustedAttackDistribution", True),
+  (Combatant, "_applyAttackRound", True),
+]
+
+def _supportSize(arg):
+  if isinstance(arg, Density):
+    return len(arg.densities)
+  if isinstance(arg, dict):
+    return len(arg)
+  return None
+
+def _sizeBin(size):
+  # histogram bins are powers of two
+  if size <= 1:
+    return size
+  return 2**math.ceil(math.log2(size))
+
+
+class Instrumentation:
+  # The instrumented operations are only patched in while enabled, so there is no overhead otherwise
+  def __init__(self):
+    self.enabled = False
+    self.trace = False
+    self._originals = []
+    self.reset()
+
+  def reset(self):
+    self.stats = {}
+    self.cacheStats = {}
+    self.statesPerRound = []
+    self.events = []
+    self._start = time.perf_counter()
+
+  def _operationStats(self, name):
+    if not name in self.stats:
+      self.stats[name] = {"calls": 0, "seconds": 0.0, "inputSupport": Counter(), "outputSupport": Counter()}
+    return self.stats[name]
+
+  def _record(self, name, args, res, start, end):
+    stats = self._operationStats(name)
+    stats["calls"] += 1
+    stats["seconds"] += end - start
+    for arg in args:
+      size = _supportSize(arg)
+      if not size is None:
+        stats["inputSupport"][_sizeBin(size)] += 1
+    size = _supportSize(res)
+    if not size is None:
+      stats["outputSupport"][_sizeBin(size)] += 1
+    if name == "Combatant._applyAttackRound":
+      self.statesPerRound.append((_supportSize(args[0]), size))
+    if self.trace:
+      self.events.append({"name": name, "ph": "X", "ts": (start - self._start)*1e6, "dur": (end - start)*1e6, "pid": 0, "tid": 0})
+
+  def _observeCache(self, name, event, details):
+    if not self.enabled:
+      return
+    if not name in self.cacheStats:
+      self.cacheStats[name] = {"calls": 0, "misses": 0}
+    if event == "call":
+      self.cacheStats[name]["calls"] += 1
+      instance, args, res, start, end = details
+      self._record(name, (instance,) + args, res, start, end)
+    else:
+      self.cacheStats[name]["misses"] += 1
+
+  def _instrumented(self, func, name):
+    @wraps(func)
+    def instrumented(*args, **kwargs):
+      start = time.perf_counter()
+      res = func(*args, **kwargs)
+      self._record(name, args, res, start, time.perf_counter())
+      return res
+    return instrumented
+
+  def enable(self, trace = False):
+    if self.enabled:
+      return self
+    self.enabled = True
+    self.trace = trace
+    for owner, attribute, isStaticMethod in _targets:
+      original = owner.__dict__[attribute]
+      func = original.__func__ if isStaticMethod else original
+      instrumented = self._instrumented(func, "{}.{}".format(owner.__name__, attribute))
+      setattr(owner, attribute, staticmethod(instrumented) if isStaticMethod else instrumented)
+      self._originals.append((owner, attribute, original))
+    densities._memoizedObserver = self._observeCache
+    return self
+
+  def disable(self):
+    for owner, attribute, original in reversed(self._originals):
+      setattr(owner, attribute, original)
+    self._originals = []
+    densities._memoizedObserver = None
+    self.enabled = False
+    return self
+
+  def __enter__(self):
+    return self.enable(self.trace)
+
+  def __exit__(self, excType, excValue, traceback):
+    self.disable()
+
+  def toDict(self):
+    cacheStats = { name: dict(s, hits = s["calls"] - s["misses"]) for name, s in self.cacheStats.items() }
+    return {
+      "operations": { name: {"calls": s["calls"], "seconds": s["seconds"], "inputSupport": dict(s["inputSupport"]), "outputSupport": dict(s["outputSupport"])} for name, s in self.stats.items() },
+      "caches": cacheStats,
+      "statesPerRound": self.statesPerRound
+    }
+
+  def report(self):
+    res = "{:<45} {:>10} {:>12} {:>14} {:>14}".format("Operation", "Calls", "Seconds", "Max. input", "Max. output") + "\n"
+    for name in sorted(self.stats, key = lambda name: -self.stats[name]["seconds"]):
+      s = self.stats[name]
+      maxInput = max(s["inputSupport"]) if s["inputSupport"] else "-"
+      maxOutput = max(s["outputSupport"]) if s["outputSupport"] else "-"
+      res += "{:<45} {:>10} {:>12.6f} {:>14} {:>14}".format(name, s["calls"], s["seconds"], maxInput, maxOutput) + "\n"
+    if self.cacheStats:
+      res += "\n" + "{:<45} {:>10} {:>12} {:>14}".format("Memoized method", "Calls", "Hits", "Misses") + "\n"
+      for name in sorted(self.cacheStats):
+        s = self.cacheStats[name]
+        res += "{:<45} {:>10} {:>12} {:>14}".format(name, s["calls"], s["calls"] - s["misses"], s["misses"]) + "\n"
+    if self.statesPerRound:
+      res += "\nStates per round: " + ", ".join(["{} -> {}".format(before, after) for (before, after) in self.statesPerRound]) + "\n"
+    return res
+
+  def save(self, filename):
+    with open(filename, "w") as f:
+      json.dump(self.toDict(), f, indent=2)
+
+  def saveTrace(self, filename):
+    # Chrome trace event format (chrome://tracing, Perfetto), only recorded with enable(trace = True)
+    with open(filename, "w") as f:
+      json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+instrumentation = Instrumentation()
+
+def instrumented(trace = False):
+  # with instrumented() as stats: ...
+  instrumentation.reset()
+  instrumentation.trace = trace
+  return instrumentation
+
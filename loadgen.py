@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+
+# Documentation: See https://github.com/jjermann/dicedensity
+
+# Load generator for server.py, measures throughput and latency percentiles, e.g.:
+#   ./loadgen.py --port 8765 --requests 2000 --concurrency 32
+#   ./loadgen.py --unix /tmp/densities.sock --distinct 200 --output results.json
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+
+_nealCombatant1 = {"type": "Dnd2NealCombatant", "hp": 20, "attackDie": "ad20", "bonusToHit": 9, "damageDie": "d8+d4", "bonusToDamage": 3, "ac": 13}
+_nealCombatant2 = {"type": "Dnd2NealCombatant", "hp": 20, "attackDie": "d20", "bonusToHit": 9, "damageDie": "d8", "bonusToDamage": 3, "ac": 18}
+
+def requestMix(distinct, seed = 0):
+  # distinct different requests (die expressions and combat queries), later requests are repeated
+  rng = random.Random(seed)
+  requests = []
+  for i in range(distinct):
+    kind = i % 4
+    if kind == 0:
+      requests.append({"op": "dieExpr", "expr": "m{}d{} + {}".format(rng.randint(1, 10), rng.choice([4, 6, 8, 10, 12, 20]), rng.randint(-5, 5)), "stats": ["expected", "stdev", "median"]})
+    elif kind == 1:
+      requests.append({"op": "dieExpr", "expr": "ad20 + {} >= {}".format(rng.randint(0, 10), rng.randint(10, 25))})
+    elif kind == 2:
+      requests.append({"op": "expectedDamage", "attacker": dict(_nealCombatant1, bonusToHit = rng.randint(0, 10)), "defender": _nealCombatant2})
+    else:
+      requests.append({"op": "winProbability", "attacker": dict(_nealCombatant1, hp = rng.randint(5, 15)), "defender": dict(_nealCombatant2, hp = rng.randint(5, 15)), "chanceDefenderStarts": 0.5, "precise": False})
+  return requests
+
+async def _open(args):
+  if args.unix is None:
+    return await asyncio.open_connection(args.host, args.port)
+  return await asyncio.open_unix_connection(args.unix)
+
+async def _send(reader, writer, request):
+  body = json.dumps(request).encode()
+  writer.write("POST / HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n".format(len(body)).encode() + body)
+  await writer.drain()
+  statusLine = await reader.readline()
+  headers = {}
+  while True:
+    line = await reader.readline()
+    if line in (b"\r\n", b"\n", b""):
+      break
+    name, value = line.decode("latin-1").split(":", 1)
+    headers[name.strip().lower()] = value.strip()
+  response = await reader.readexactly(int(headers.get("content-length", 0)))
+  return (int(statusLine.split()[1]), json.loads(response))
+
+async def _client(args, queue, latencies, errors):
+  reader, writer = await _open(args)
+  try:
+    while True:
+      try:
+        request = queue.get_nowait()
+      except asyncio.QueueEmpty:
+        break
+      start = time.perf_counter()
+      status, response = await _send(reader, writer, request)
+      latencies.append(time.perf_counter() - start)
+      if status != 200:
+        errors.append(response)
+  finally:
+    writer.close()
+
+def _percentile(sortedValues, p):
+  return sortedValues[min(len(sortedValues) - 1, int(p*len(sortedValues)))]
+
+async def run(args):
+  mix = requestMix(args.distinct, args.seed)
+  rng = random.Random(args.seed)
+  queue = asyncio.Queue()
+  for i in range(args.requests):
+    queue.put_nowait(rng.choice(mix))
+  latencies = []
+  errors = []
+  start = time.perf_counter()
+  await asyncio.gather(*[ _client(args, queue, latencies, errors) for i in range(args.concurrency) ])
+  duration = time.perf_counter() - start
+  latencies.sort()
+  return {
+    "requests": len(latencies),
+    "errors": len(errors),
+    "concurrency": args.concurrency,
+    "distinct": args.distinct,
+    "seconds": duration,
+    "throughput": len(latencies)/duration,
+    "latency": { "mean": sum(latencies)/len(latencies), "p50": _percentile(latencies, 0.5), "p90": _percentile(latencies, 0.9),
+                 "p99": _percentile(latencies, 0.99), "max": latencies[-1] }
+  }
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Load generator for server.py")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8765)
+  parser.add_argument("--unix", help="connect to the given Unix socket instead of TCP")
+  parser.add_argument("--requests", type=int, default=1000, help="total number of requests")
+  parser.add_argument("--concurrency", type=int, default=16, help="number of concurrent connections")
+  parser.add_argument("--distinct", type=int, default=100, help="number of distinct requests in the mix")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--output", help="write the results as JSON to the given file")
+  args = parser.parse_args()
+
+  results = asyncio.run(run(args))
+  print("{} requests ({} errors) in {:.2f}s: {:.1f} requests/s".format(results["requests"], results["errors"], results["seconds"], results["throughput"]), file=sys.stderr)
+  print("Latency: " + ", ".join(["{} {:.2f}ms".format(k, 1000*v) for k, v in results["latency"].items()]), file=sys.stderr)
+  if not args.output is None:
+    with open(args.output, "w") as f:
+      json.dump(results, f, indent=2)
@@ -4,6 +4,7 @@
 
 from densities import *
 from combatant import *
+import numpy as np
 
 
 # Probabilities to find a certain number of rations of food when searching for "turnsToSearch" turns
@@ -37,12 +38,21 @@ def spellDuration(bonusAttacker, bonusDefender):
       return 0
   return finalDuration
 
+# The same as spellDuration but working on numpy arrays of rolls (used with vectorizedMultiOp)
+def vectorizedSpellDuration(bonusAttacker, bonusDefender):
+  def finalDuration(attackRoll, defendRoll):
+    difference = (attackRoll + bonusAttacker) - (defendRoll + bonusDefender)
+    duration = np.where(difference > 0, difference, 0)
+    duration = np.where(defendRoll == 1, np.maximum(1, difference), duration)
+    return np.where(defendRoll == 20, 0, duration)
+  return finalDuration
+
 # Win probability of attacker (cases where spellDuration > 0.0), parametrized by bonusAttacker
 attackerDie = d20.asMultiDensity(2).drop_lowest(1)
 defenderDie = d20
 
 def durationDensity(bonusAttacker):
-  return MultiDensity(attackerDie, defenderDie).multiOp(spellDuration(bonusAttacker, 0))
+  return MultiDensity(attackerDie, defenderDie).vectorizedMultiOp(vectorizedSpellDuration(bonusAttacker, 0))
 
 def winProbability(bonusAttacker):
   return durationDensity(bonusAttacker) > 0
@@ -0,0 +1,224 @@
+from densities import *
+import densities
+import ast
+from combatant import *
+from sharedDensities import SharedDensityStore, SharedDensityHandle
+import bisect
+from collections import Counter
+from itertools import accumulate
+from concurrent.futures import ProcessPoolExecutor
+from statistics import NormalDist
+import time
+
+
+class EstimatedDensity(Density):
+  def __init__(self, counts, samples, confidence=0.95):
+    self.counts = counts
+    self.samples = samples
+    self.confidence = confidence
+    Density.__init__(self, { k: c / samples for k, c in counts.items() })
+
+  def _z(self):
+    return NormalDist().inv_cdf(0.5 + self.confidence/2.0)
+
+  def confidenceInterval(self, key):
+    # Wilson score interval for the probability of the given outcome
+    z = self._z()
+    n = self.samples
+    p = self.counts.get(key, 0) / n
+    center = (p + z**2/(2*n)) / (1 + z**2/n)
+    halfWidth = z*math.sqrt(p*(1 - p)/n + z**2/(4*n**2)) / (1 + z**2/n)
+    return (max(0.0, center - halfWidth), min(1.0, center + halfWidth))
+
+  def maxError(self):
+    # Half-width of the Dvoretzky-Kiefer-Wolfowitz band: with the given confidence the estimated CDF is within maxError
+    # of the true CDF at every outcome simultaneously (so every probability of a single outcome is within 2*maxError).
+    # Unlike per-outcome intervals this doesn't get small for wide supports where every single outcome is unlikely.
+    return math.sqrt(math.log(2.0/(1.0 - self.confidence))/(2.0*self.samples))
+
+
+def _sampleArrays(arrays, size, rng):
+  keys, probs = arrays
+  cumulative = np.cumsum(probs)
+  indices = np.searchsorted(cumulative, rng.random(size)*cumulative[-1], side='right')
+  return keys[np.minimum(indices, len(keys) - 1)]
+
+def _multiOpBatch(arraysList, opr, vectorized, size, seed):
+  # in worker processes the densities are attached from shared memory (see estimateMultiOp)
+  arraysList = [ a.arrays() if isinstance(a, SharedDensityHandle) else a for a in arraysList ]
+  rng = np.random.default_rng(seed)
+  samples = [ _sampleArrays(arrays, size, rng) for arrays in arraysList ]
+  if vectorized:
+    results, counts = np.unique(np.asarray(opr(*samples)), return_counts=True)
+    return dict(zip(results.tolist(), counts.tolist()))
+  return Counter([ opr(*row) for row in zip(*[ s.tolist() for s in samples ]) ])
+
+def _cumulative(probs):
+  return list(accumulate(probs))
+
+def _inverseCdf(cumulative, u):
+  return min(bisect.bisect_right(cumulative, u*cumulative[-1]), len(cumulative) - 1)
+
+def _attack(attacker, defender, u, v, cache):
+  # Samples the same transition as Combatant._adjustedSingleAttackDistribution(precise=True)
+  if attacker.cantFight():
+    return defender
+  key = (attacker._state(), defender._state())
+  if key not in cache:
+    dd = attacker.damageDensityDistribution(defender)
+    outcomes = [ (damageDensity.isZero(), damageDensity.keys(), _cumulative(damageDensity.values())) for damageDensity in dd ]
+    cache[key] = (_cumulative(dd.values()), outcomes)
+  cumulative, outcomes = cache[key]
+  isZero, damages, damageCumulative = outcomes[_inverseCdf(cumulative, u)]
+  if isZero:
+    return defender
+  clone = defender.clone()
+  clone.hp = max(0, clone.hp - damages[_inverseCdf(damageCumulative, v)])
+  if not clone.maxFatigue is None and clone.fatigue < clone.maxFatigue:
+    clone.fatigue += 1
+  return clone
+
+def _combatBatch(attacker, defender, op, rounds, chanceDefenderStarts, maxRounds, size, seed):
+  rng = np.random.default_rng(seed)
+  # combatants only compare by (hp, fatigue), so each direction needs its own cache
+  attackerCache = {}
+  defenderCache = {}
+  fights = [ (attacker, defender) ] * size
+  if not chanceDefenderStarts is None:
+    starts = (rng.random(size) < chanceDefenderStarts).tolist()
+    u, v = rng.random((2, size)).tolist()
+    fights = [ (_attack(defender, attacker, u[i], v[i], defenderCache), defender) if starts[i] else fights[i] for i in range(size) ]
+
+  undecided = lambda a, d: a.canFight() and d.canFight()
+  for round in range(rounds if not rounds is None else maxRounds):
+    active = [ i for i in range(size) if undecided(*fights[i]) ] if rounds is None else range(size)
+    if not active:
+      break
+    u1, v1, u2, v2 = rng.random((4, len(active))).tolist()
+    for j, i in enumerate(active):
+      a, d = fights[i]
+      d = _attack(a, d, u1[j], v1[j], attackerCache)
+      a = _attack(d, a, u2[j], v2[j], defenderCache)
+      fights[i] = (a, d)
+  return Counter([ op(a, d) for (a, d) in fights ])
+
+# Size of the first batch if there is a deadline (the following batches are sized by the measured sampling rate)
+_firstDeadlineBatch = 1000
+
+def _estimate(batch, args, precision, confidence, batchSize, maxSamples, processes, seed, deadline=None):
+  # deadline: the sampling stops (with the estimate so far) before it would take longer than deadline seconds
+  start = time.perf_counter()
+  seeds = np.random.SeedSequence(seed)
+  counts = Counter()
+  samples = 0
+  estimate = None
+  executor = ProcessPoolExecutor(processes) if processes else None
+  try:
+    while samples < maxSamples:
+      size = min(batchSize, maxSamples - samples)
+      if not deadline is None:
+        elapsed = time.perf_counter() - start
+        if samples == 0:
+          size = min(size, _firstDeadlineBatch)
+        else:
+          size = min(size, int(samples/max(elapsed, 1e-9)*(deadline - elapsed)/(processes or 1)))
+          if size < 1:
+            break
+      if executor is None:
+        results = [ batch(*args, size, seeds.spawn(1)[0]) ]
+      else:
+        futures = [ executor.submit(batch, *args, size, s) for s in seeds.spawn(processes) ]
+        results = [ f.result() for f in futures ]
+      for res in results:
+        counts.update(res)
+        samples += sum(res.values())
+      estimate = EstimatedDensity(dict(counts), samples, confidence)
+      if estimate.maxError() <= precision:
+        break
+  finally:
+    if not executor is None:
+      executor.shutdown()
+  return estimate
+
+def estimateMultiOp(densityList, opr, vectorized=False, precision=0.005, confidence=0.95, batchSize=100000, maxSamples=10**7, processes=None, seed=None, deadline=None):
+  if not processes:
+    arraysList = [ Density._getDensity(d)._getArrays() for d in densityList ]
+    return _estimate(_multiOpBatch, (arraysList, opr, vectorized), precision, confidence, batchSize, maxSamples, processes, seed, deadline)
+  with SharedDensityStore() as store:
+    arraysList = [ _publishedArrays(store, d) for d in densityList ]
+    return _estimate(_multiOpBatch, (arraysList, opr, vectorized), precision, confidence, batchSize, maxSamples, processes, seed, deadline)
+
+def _publishedArrays(store, density):
+  try:
+    return store.publish(density)
+  except ValueError:
+    # densities with other outcomes are passed to the workers as they are
+    return Density._getDensity(density)._getArrays()
+
+def _sampleNode(node, size, rng):
+  # Mirrors densities._eval but works on arrays of samples
+  if densities._isNumber(node):
+    return np.full(size, node.value)
+  pool = densities._poolToken(node)
+  if not pool is None:
+    nr, prefix, die, thresholds = pool
+    return densities._baseDie(prefix, die).successCount(nr, *thresholds).sample(size, rng)
+  token = densities._dieToken(node)
+  if not token is None:
+    nr, prefix, die = token
+    keys, probs = densities._baseDie(prefix, die)._getArrays()
+    if nr > len(keys):
+      # How often each outcome occurs is multinomial, independent of the number of dice
+      return rng.multinomial(nr, probs/probs.sum(), size=size) @ keys
+    res = np.zeros(size, dtype=keys.dtype)
+    for i in range(nr):
+      res += _sampleArrays((keys, probs), size, rng)
+    return res
+  if isinstance(node, ast.BinOp):
+    return densities._operators[type(node.op)](_sampleNode(node.left, size, rng), _sampleNode(node.right, size, rng))
+  if isinstance(node, ast.UnaryOp):
+    return densities._operators[type(node.op)](_sampleNode(node.operand, size, rng))
+  if isinstance(node, ast.Compare) and len(node.ops) == 1 and len(node.comparators) == 1:
+    return densities._operators[type(node.ops[0])](_sampleNode(node.left, size, rng), _sampleNode(node.comparators[0], size, rng))
+  raise TypeError(node)
+
+def _expressionBatch(expr, simplify, size, seed):
+  rng = np.random.default_rng(seed)
+  results, counts = np.unique(_sampleNode(densities._parse_expr(expr, simplify), size, rng), return_counts=True)
+  return dict(zip(results.tolist(), counts.tolist()))
+
+def estimateExpression(expr, simplify=True, includeError=False, precision=0.005, confidence=0.95, batchSize=100000, maxSamples=10**7, processes=None, seed=None, deadline=None):
+  # Comparisons result in a probability (as for DieExpr), everything else in an EstimatedDensity
+  estimate = _estimate(_expressionBatch, (expr, simplify), precision, confidence, batchSize, maxSamples, processes, seed, deadline)
+  if not isinstance(densities._parse_expr(expr, simplify), ast.Compare):
+    return estimate
+  p = estimate.densities.get(True, 0.0)
+  if includeError:
+    return (p, estimate.confidenceInterval(True))
+  return p
+
+def estimateCombatResultDensity(attacker, defender, op, rounds=None, chanceDefenderStarts=None, precision=0.005, confidence=0.95, batchSize=10000, maxSamples=10**6, processes=None, seed=None, maxRounds=1000, deadline=None):
+  args = (attacker, defender, op, rounds, chanceDefenderStarts, maxRounds)
+  return _estimate(_combatBatch, args, precision, confidence, batchSize, maxSamples, processes, seed, deadline)
+
+class _EventIndicator:
+  # picklable replacement for lambda a, d: bool(cond(a, d)) (needed for worker processes)
+  def __init__(self, cond):
+    self.cond = cond
+
+  def __call__(self, attacker, defender):
+    return bool(self.cond(attacker, defender))
+
+def _defenderCantFight(attacker, defender):
+  return defender.cantFight()
+
+def estimateCombatEventProbability(attacker, defender, cond, rounds=None, chanceDefenderStarts=None, includeError=False, **kwargs):
+  estimate = estimateCombatResultDensity(attacker, defender, _EventIndicator(cond), rounds, chanceDefenderStarts, **kwargs)
+  p = estimate.densities.get(True, 0.0)
+  if includeError:
+    return (p, estimate.confidenceInterval(True))
+  return p
+
+def estimateWinProbability(attacker, defender, chanceDefenderStarts=None, includeError=False, **kwargs):
+  return estimateCombatEventProbability(attacker, defender, _defenderCantFight, None, chanceDefenderStarts, includeError, **kwargs)
+
@@ -0,0 +1,238 @@
+#!/usr/bin/python3
+
+# Documentation: See https://github.com/jjermann/dicedensity
+
+# Local evaluation service for die expressions and combat queries (JSON over HTTP, TCP or Unix socket), e.g.:
+#   ./server.py --port 8765 --workers 4
+#   curl -d '{"op": "dieExpr", "expr": "m3d6 + 2", "stats": ["expected", "stdev"]}' http://localhost:8765/
+
+from densities import *
+from combatant import *
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import argparse
+import asyncio
+import json
+
+
+# Evaluation (runs in the worker processes)
+
+_combatantTypes = {
+  "Combatant": Combatant,
+  "DndCombatant": DndCombatant,
+  "Dnd2NealCombatant": Dnd2NealCombatant,
+  "DndNealTestCombatant": DndNealTestCombatant
+}
+
+# options are the limits of the evaluation: budget and onBudgetExceeded (as for DieExpr) and maxRounds of combats
+def _density(spec, options):
+  if isinstance(spec, (int, float)):
+    return Constant(spec)
+  return DieExpr(spec, budget = options["budget"], onBudgetExceeded = options["onBudgetExceeded"])
+
+def _combatant(spec, options):
+  # e.g. {"type": "Dnd2NealCombatant", "hp": 20, "attackDie": "ad20", "bonusToHit": 9, "damageDie": "d8+d4", "bonusToDamage": 3, "ac": 13}
+  spec = dict(spec)
+  combatantType = _combatantTypes[spec.pop("type", "Combatant")]
+  for field in ("attackDie", "damageDie"):
+    if field in spec:
+      spec[field] = _density(spec[field], options)
+  return combatantType(**spec)
+
+def _densityResult(d, request):
+  res = {}
+  stats = request.get("stats", ["expected", "stdev"])
+  if "expected" in stats:
+    res["expected"] = d.expected()
+  if "stdev" in stats:
+    res["stdev"] = d.stdev()
+  if "median" in stats:
+    res["median"] = d.median()
+  if "cdf" in request:
+    res["cdf"] = [ [x, d.cdf(x)] for x in request["cdf"] ]
+  if request.get("density", False):
+    res["density"] = [ [k, d[k]] for k in d.keys() ]
+  return res
+
+def _dieExpr(request, options):
+  res = DieExpr(request["expr"], budget = options["budget"], onBudgetExceeded = options["onBudgetExceeded"])
+  if isinstance(res, Density):
+    return _densityResult(res, request)
+  return {"probability": res}
+
+def _combatSolution(request, options):
+  attacker = _combatant(request["attacker"], options)
+  defender = _combatant(request["defender"], options)
+  return CombatSolution(attacker, defender, request.get("chanceDefenderStarts"), request.get("precise", True), request.get("simple", False))
+
+def _combatLimits(options):
+  # the deadline of the budget limits the runtime of the combat simulation (there is no cost estimate for it)
+  budget = options["budget"]
+  return {"maxRounds": options["maxRounds"], "deadline": None if budget is None else budget.deadline}
+
+def _combatBudgetExceeded(solution, limits):
+  violations = []
+  if not limits["maxRounds"] is None and solution.rounds >= limits["maxRounds"]:
+    violations.append("rounds {} >= {}".format(solution.rounds, limits["maxRounds"]))
+  if not limits["deadline"] is None:
+    violations.append("time > {}s".format(limits["deadline"]))
+  return BudgetExceededError("The combat", None, violations[:1])
+
+def _winProbability(request, options):
+  # If the limits are reached first the result has a larger error (or BudgetExceededError is raised with onBudgetExceeded="raise")
+  limits = _combatLimits(options)
+  maxError = request.get("maxError", 0.005)
+  solution = _combatSolution(request, options).refine(maxError, **limits)
+  if solution.undecidedProbability() > maxError and options["onBudgetExceeded"] == "raise":
+    raise _combatBudgetExceeded(solution, limits)
+  p = solution.winProbability(includeError = True)
+  return {"probability": p[0], "minProbability": p[1], "error": p[2]}
+
+def _hpDensity(request, options):
+  # Same distribution as Combatant.hpDensity, the rounds are limited by maxRounds and the deadline of the budget
+  limits = _combatLimits(options)
+  rounds = request.get("rounds", 1)
+  if not limits["maxRounds"] is None and rounds > limits["maxRounds"]:
+    raise BudgetExceededError("The combat", None, ["rounds {} > {}".format(rounds, limits["maxRounds"])])
+  solution = _combatSolution(request, options).refine(0.0, maxRounds = rounds, deadline = limits["deadline"])
+  if solution.rounds < rounds and solution.undecidedProbability() > 0.0:
+    raise _combatBudgetExceeded(solution, limits)
+  d = Combatant.resultDensity(solution.distribution(), lambda attacker, defender: attacker.hp)
+  return _densityResult(d, dict(request, density = request.get("density", True)))
+
+def _expectedDamage(request, options):
+  attacker = _combatant(request["attacker"], options)
+  defender = _combatant(request["defender"], options)
+  return {"expectedDamage": attacker.expectedDamage(defender), "chanceToHit": attacker.chanceToHit(defender)}
+
+_operations = {
+  "dieExpr": _dieExpr,
+  "winProbability": _winProbability,
+  "hpDensity": _hpDensity,
+  "expectedDamage": _expectedDamage
+}
+
+def evaluate(request, budget = None, onBudgetExceeded = "raise", maxRounds = None):
+  # budget (see Budget) limits the die expressions of the request, e.g. Budget(deadline = 1.0),
+  # its deadline and maxRounds limit the combat simulations as well
+  if not request.get("op") in _operations:
+    raise ValueError("Unknown operation: {}".format(request.get("op")))
+  return _operations[request["op"]](request, {"budget": budget, "onBudgetExceeded": onBudgetExceeded, "maxRounds": maxRounds})
+
+
+# Server
+
+class EvaluationServer:
+  # Identical requests share one evaluation (in-flight coalescing) and one cache for all clients.
+  # Die expressions whose estimated runtime exceeds budget seconds are rejected resp. sampled (onBudgetExceeded="sample"),
+  # combats are stopped after budget seconds resp. maxRounds rounds (None: no limit).
+  def __init__(self, workers = None, cacheSize = 10000, budget = 10.0, onBudgetExceeded = "raise", maxRounds = 1000):
+    if workers == 0:
+      self.executor = ThreadPoolExecutor(1)
+    else:
+      self.executor = ProcessPoolExecutor(workers)
+    self.cache = OrderedDict()
+    self.cacheSize = cacheSize
+    self.budget = None if budget is None else Budget(deadline = budget)
+    self.onBudgetExceeded = onBudgetExceeded
+    self.maxRounds = maxRounds
+    self.inFlight = {}
+    self.stats = {"requests": 0, "cacheHits": 0, "coalesced": 0, "evaluations": 0, "errors": 0, "budgetExceeded": 0}
+
+  async def query(self, request):
+    key = json.dumps(request, sort_keys = True)
+    self.stats["requests"] += 1
+    if key in self.cache:
+      self.stats["cacheHits"] += 1
+      self.cache.move_to_end(key)
+      return self.cache[key]
+    if key in self.inFlight:
+      self.stats["coalesced"] += 1
+      return await asyncio.shield(self.inFlight[key])
+    future = asyncio.get_running_loop().run_in_executor(self.executor, evaluate, request, self.budget, self.onBudgetExceeded, self.maxRounds)
+    self.inFlight[key] = future
+    self.stats["evaluations"] += 1
+    try:
+      result = await future
+    finally:
+      del self.inFlight[key]
+    self.cache[key] = result
+    if len(self.cache) > self.cacheSize:
+      self.cache.popitem(last = False)
+    return result
+
+  async def _handleRequest(self, method, path, body):
+    if method == "GET" and path == "/stats":
+      return (200, dict(self.stats, cacheSize = len(self.cache)))
+    if method != "POST":
+      return (404, {"error": "Use POST / with a JSON request or GET /stats"})
+    try:
+      request = json.loads(body)
+      return (200, await self.query(request))
+    except BudgetExceededError as e:
+      self.stats["budgetExceeded"] += 1
+      return (422, {"error": "{}: {}".format(type(e).__name__, e), "violations": e.violations})
+    except Exception as e:
+      self.stats["errors"] += 1
+      return (400, {"error": "{}: {}".format(type(e).__name__, e)})
+
+  async def handleConnection(self, reader, writer):
+    # Minimal HTTP/1.1 with keep-alive
+    try:
+      while True:
+        requestLine = await reader.readline()
+        if not requestLine:
+          break
+        method, path, version = requestLine.decode("latin-1").split()
+        headers = {}
+        while True:
+          line = await reader.readline()
+          if line in (b"\r\n", b"\n", b""):
+            break
+          name, value = line.decode("latin-1").split(":", 1)
+          headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+        status, result = await self._handleRequest(method, path, body)
+        response = json.dumps(result).encode()
+        keepAlive = headers.get("connection", "keep-alive" if version == "HTTP/1.1" else "close").lower() != "close"
+        writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n".format(
+          status, "OK" if status == 200 else "Error", len(response), "keep-alive" if keepAlive else "close").encode() + response)
+        await writer.drain()
+        if not keepAlive:
+          break
+    except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+      pass
+    finally:
+      writer.close()
+
+  async def serve(self, host = "127.0.0.1", port = 8765, unixSocket = None):
+    if unixSocket is None:
+      server = await asyncio.start_server(self.handleConnection, host, port)
+    else:
+      server = await asyncio.start_unix_server(self.handleConnection, unixSocket)
+    async with server:
+      await server.serve_forever()
+
+  def close(self):
+    self.executor.shutdown()
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Local evaluation service for die expressions and combat queries")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8765)
+  parser.add_argument("--unix", help="listen on the given Unix socket instead of TCP")
+  parser.add_argument("--workers", type=int, help="number of worker processes (default: number of CPUs, 0: evaluate in a thread)")
+  parser.add_argument("--cache-size", type=int, default=10000, help="maximal number of cached results")
+  parser.add_argument("--budget", type=float, default=10.0, help="maximal estimated runtime of a die expression resp. runtime of a combat in seconds (default: 10, 0: no limit)")
+  parser.add_argument("--on-budget-exceeded", choices=["raise", "sample"], default="raise", help="reject (HTTP 422) resp. estimate by sampling die expressions exceeding the budget (combats return a less precise result)")
+  parser.add_argument("--max-rounds", type=int, default=1000, help="maximal number of combat rounds (default: 1000, 0: no limit)")
+  args = parser.parse_args()
+
+  evaluationServer = EvaluationServer(args.workers, args.cache_size, args.budget or None, args.on_budget_exceeded, args.max_rounds or None)
+  try:
+    asyncio.run(evaluationServer.serve(args.host, args.port, args.unix))
+  except KeyboardInterrupt:
+    pass
+  finally:
+    evaluationServer.close()
@@ -0,0 +1,205 @@
+from densities import *
+from combatantProfile import ArtifactCache, CombatantProfile, artifactCache
+from collections.abc import Mapping
+from multiprocessing import shared_memory
+import bisect
+import os
+import sys
+import threading
+import uuid
+
+# Published arrays are aligned to 8 bytes within their segment
+_alignment = 8
+
+# Segments and densities attached by this process: {location: buffer} resp. {(location, offset): ArrayDensity}.
+# They stay attached for the lifetime of the process, so attaching the same handle again is free.
+_attachedSegments = {}
+_attachedDensities = {}
+_attachLock = threading.Lock()
+
+def _sharedArray(density):
+  keys, probs = Density._getDensity(density)._getArrays()
+  if keys.ndim != 1:
+    raise ValueError("Only densities with integer or float outcomes can be shared!")
+  if keys.dtype.kind == 'i':
+    keys = keys.astype(np.int64)
+  elif keys.dtype.kind == 'f':
+    keys = keys.astype(np.float64)
+  else:
+    raise ValueError("Only densities with integer or float outcomes can be shared!")
+  return (keys, probs.astype(np.float64))
+
+def _layout(arrays):
+  # [(dtype, length, offset)] of the arrays stored one after the other
+  layout = []
+  offset = 0
+  for a in arrays:
+    layout.append((a.dtype.str, len(a), offset))
+    offset += -(-a.nbytes // _alignment) * _alignment
+  return (layout, offset)
+
+def _attachSegment(location):
+  kind, name = location
+  with _attachLock:
+    if not location in _attachedSegments:
+      if kind == "file":
+        _attachedSegments[location] = np.memmap(name, dtype=np.uint8, mode='r')
+      elif sys.version_info >= (3, 13):
+        # attached segments are owned (and unlinked) by the publishing store
+        _attachedSegments[location] = shared_memory.SharedMemory(name, track=False)
+      else:
+        _attachedSegments[location] = shared_memory.SharedMemory(name)
+    return _attachedSegments[location]
+
+def _attachArray(location, dtype, length, offset):
+  segment = _attachSegment(location)
+  buffer = segment if location[0] == "file" else segment.buf
+  res = np.ndarray((length,), dtype=dtype, buffer=buffer, offset=offset)
+  res.flags.writeable = False
+  return res
+
+
+class _ArrayMapping(Mapping):
+  # Read-only dictionary view {outcome: probability} of sorted outcome and probability arrays
+  def __init__(self, keys, probs):
+    self._keys = keys
+    self._probs = probs
+
+  def __getitem__(self, key):
+    try:
+      i = bisect.bisect_left(self._keys, key)
+    except TypeError:
+      raise KeyError(key)
+    if i < len(self._keys) and self._keys[i] == key:
+      return float(self._probs[i])
+    raise KeyError(key)
+
+  def __iter__(self):
+    return iter(self._keys.tolist())
+
+  def __len__(self):
+    return len(self._keys)
+
+  def items(self):
+    return zip(self._keys.tolist(), self._probs.tolist())
+
+  def values(self):
+    return self._probs.tolist()
+
+
+class ArrayDensity(Density):
+  # Read-only density backed by the (sorted) arrays of outcomes and probabilities, e.g. in shared memory.
+  # numpy based operations (comparisons, additions of integer densities, maxDensity, sample, ...) work directly on the arrays.
+  def __init__(self, keys, probs):
+    Density.__init__(self, {})
+    self.densities = _ArrayMapping(keys, probs)
+    self._arrays = (keys, probs)
+
+  def __reduce__(self):
+    # pickled as a regular density, use SharedDensityHandle to pass it to other processes without copying
+    return (Density, (dict(self.densities.items()),))
+
+  def keys(self):
+    return self._arrays[0].tolist()
+
+  def values(self):
+    return self._arrays[1].tolist()
+
+
+class SharedDensityHandle:
+  # Picklable reference to a density published by a SharedDensityStore
+  def __init__(self, location, keysLayout, probsLayout):
+    self.location = location
+    self.keysLayout = keysLayout
+    self.probsLayout = probsLayout
+
+  def arrays(self):
+    return (_attachArray(self.location, *self.keysLayout), _attachArray(self.location, *self.probsLayout))
+
+  def attach(self):
+    key = (self.location, self.keysLayout[2])
+    density = _attachedDensities.get(key)
+    if density is None:
+      density = _attachedDensities.setdefault(key, ArrayDensity(*self.arrays()))
+    return density
+
+
+class SharedDistributionHandle:
+  # Picklable reference to a published damage density distribution {damageDensity: probability}
+  # (see Combatant.damageDensityDistribution) together with the key it's cached under by combatant profiles
+  def __init__(self, location, densityHandles, probsLayout, cacheKey):
+    self.location = location
+    self.densityHandles = densityHandles
+    self.probsLayout = probsLayout
+    self.cacheKey = cacheKey
+
+  def attach(self):
+    probs = _attachArray(self.location, *self.probsLayout).tolist()
+    return dict(zip([ h.attach() for h in self.densityHandles ], probs))
+
+  def install(self, cache = None):
+    # Profiled combatants (see combatantProfile.py) then use the shared distribution instead of calculating it
+    cache = artifactCache if cache is None else cache
+    distribution = self.attach()
+    cache.put(self.cacheKey, distribution)
+    return distribution
+
+
+class SharedDensityStore:
+  # Publishes densities once for worker processes, in shared memory or (with directory) in memory mapped files.
+  # The published data is removed by close() (resp. at the end of a with block).
+  def __init__(self, directory = None):
+    self.directory = directory
+    self._segments = []
+
+  def _publishArrays(self, arrays):
+    layout, size = _layout(arrays)
+    if self.directory is None:
+      segment = shared_memory.SharedMemory(create=True, size=max(size, 1))
+      location = ("shm", segment.name)
+      self._segments.append(segment)
+      for a, (dtype, length, offset) in zip(arrays, layout):
+        segment.buf[offset:offset + a.nbytes] = a.tobytes()
+    else:
+      filename = os.path.join(self.directory, "density-{}.bin".format(uuid.uuid4().hex))
+      location = ("file", filename)
+      self._segments.append(filename)
+      with open(filename, "wb") as f:
+        for a, (dtype, length, offset) in zip(arrays, layout):
+          f.seek(offset)
+          f.write(a.tobytes())
+        f.truncate(max(size, 1))
+    return (location, layout)
+
+  def publish(self, density):
+    location, (keysLayout, probsLayout) = self._publishArrays(_sharedArray(density))
+    return SharedDensityHandle(location, keysLayout, probsLayout)
+
+  def publishDistribution(self, distribution, cacheKey = None):
+    # All densities of the distribution are stored in one segment
+    densityArrays = [ _sharedArray(d) for d in distribution ]
+    arrays = [ a for pair in densityArrays for a in pair ] + [ np.array(list(distribution.values()), dtype=np.float64) ]
+    location, layout = self._publishArrays(arrays)
+    densityHandles = [ SharedDensityHandle(location, layout[2*i], layout[2*i + 1]) for i in range(len(densityArrays)) ]
+    return SharedDistributionHandle(location, densityHandles, layout[-1], cacheKey)
+
+  def publishDamageDistribution(self, attacker, defender):
+    attacker = attacker.combatant() if isinstance(attacker, CombatantProfile) else attacker
+    defender = defender.combatant() if isinstance(defender, CombatantProfile) else defender
+    cacheKey = ("damageDensityDistribution", ArtifactCache.damageKey(attacker, defender))
+    return self.publishDistribution(attacker.damageDensityDistribution(defender), cacheKey)
+
+  def close(self):
+    for segment in self._segments:
+      if isinstance(segment, str):
+        os.remove(segment)
+      else:
+        segment.close()
+        segment.unlink()
+    self._segments = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    self.close()
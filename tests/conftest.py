@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The modules are in the repository root, plots are rendered without a display
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("MPLBACKEND", "Agg")
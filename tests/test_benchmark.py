@@ -0,0 +1,24 @@
+import benchmark
+
+
+def testConvolveMatchesBinOp():
+  convolve = dict(benchmark.benchmarks)["convolve/m10d20+m10d20"]()()
+  binOp = dict(benchmark.benchmarks)["binOp/m10d20+m10d20"]()()
+  assert convolve.densities.keys() == binOp.densities.keys()
+  assert max([ abs(convolve[k] - binOp[k]) for k in binOp.keys() ]) < 1e-12
+
+def testRunBenchmarks():
+  run = benchmark.runBenchmarks("^convolve/m10d6|dieExpr", repeat=2, verbose=False, minTime=0.01)
+  assert sorted(run["results"].keys()) == ["convolve/m10d6+m10d6", "dieExpr/parse"]
+  for result in run["results"].values():
+    assert result["repeat"] == 2 and result["loops"] >= 1
+    assert 0.0 < result["min"] <= result["median"]
+    assert result["peakMemory"] > 0
+
+def testCompareRuns():
+  before = {"results": {"a": {"min": 1.0, "peakMemory": 100}, "b": {"min": 1.0, "peakMemory": 100}, "c": {"min": 1.0, "peakMemory": 100}}}
+  after = {"results": {"a": {"min": 1.5, "peakMemory": 100}, "b": {"min": 0.5, "peakMemory": 100}, "c": {"min": 1.0, "peakMemory": 105}}}
+  lines = benchmark.compareRuns(before, after).splitlines()
+  assert lines[1].startswith("a") and lines[1].endswith("(regression)")
+  assert lines[2].startswith("b") and lines[2].endswith("(improvement)")
+  assert lines[3].startswith("c") and not "(" in lines[3]
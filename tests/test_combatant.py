@@ -0,0 +1,93 @@
+from combatant import *
+import pytest
+
+
+def mainCombatants():
+  combatant1 = Combatant(hp=20, maxFatigue=10, attackDie=ad20, bonusToHit=3, damageDie=d4, bonusToDamage=2, evade=2, armor=5, resistance=0)
+  combatant2 = Combatant(hp=20, maxFatigue=10, attackDie=d20, bonusToHit=1, damageDie=d8, bonusToDamage=-1, evade=5, armor=10, resistance=6)
+  return (combatant1, combatant2)
+
+def smallCombatants():
+  fighter = Combatant(hp=8, attackDie=d20, bonusToHit=2, damageDie=d6, bonusToDamage=1, evade=12)
+  goblin = Combatant(hp=6, attackDie=d20, bonusToHit=1, damageDie=d4, bonusToDamage=1, evade=11)
+  return (fighter, goblin)
+
+def testQuantizedCombatants():
+  combatant, other = mainCombatants()
+  combatant.hp = 12
+  assert combatant._quantizedCombatants(1) == ([(combatant, 1.0)], False)
+  combatant.hp = 12 + 1e-12
+  quantized, moved = combatant._quantizedCombatants(1)
+  assert [ (c.hp, p) for c, p in quantized ] == [(12, 1.0)] and not moved
+  combatant.hp = 12.25
+  quantized, moved = combatant._quantizedCombatants(1)
+  assert moved and abs(sum([ c.hp*p for c, p in quantized ]) - 12.25) < 1e-12
+  # living combatants below the first grid point are neither revived nor killed
+  combatant.hp = 0.4
+  quantized, moved = combatant._quantizedCombatants(1)
+  assert [ (c.hp, p) for c, p in quantized ] == [(0.4, 1.0)] and not moved
+
+def testGridDoesNotIncreaseStates():
+  combatant1, combatant2 = mainCombatants()
+  d = Combatant.combatDistribution(combatant1, combatant2, 6, precise=False)
+  dGrid, error = Combatant.combatDistribution(combatant1, combatant2, 6, precise=False, hpGrid=1, includeError=True)
+  assert len(dGrid) <= len(d)
+
+def testGridErrorBound():
+  combatant1 = Combatant(hp=25, attackDie=ad20, bonusToHit=3, damageDie=d4+d6, bonusToDamage=2, evade=8, armor=2, resistance=2, criticalThreshold=4)
+  combatant2 = Combatant(hp=25, attackDie=d20, bonusToHit=2, damageDie=d8+d3, bonusToDamage=-1, evade=7, armor=3, resistance=3, criticalThreshold=6)
+  won = lambda d: sum([ p for (attacker, defender), p in d.items() if defender.cantFight() ])
+  d = Combatant.combatDistribution(combatant1, combatant2, 4, precise=False)
+  dGrid, error = Combatant.combatDistribution(combatant1, combatant2, 4, precise=False, hpGrid=2, includeError=True)
+  assert len(dGrid) < len(d) and error > 0.0
+  assert abs(won(dGrid) - won(d)) <= error
+
+def testExpectedDamageWinProbability():
+  combatant1, combatant2 = mainCombatants()
+  p, minP, error = combatant1.winProbability(combatant2, precise=False, maxError=0.001, includeError=True)
+  assert minP <= p <= minP + error + 1e-12
+  assert abs(p - 0.2263) < 0.001
+  assert combatant1.winProbability(combatant2, precise=False, maxError=0.001, hpGrid=1) == p
+
+def testAttackDamageDensity():
+  combatant1, combatant2 = mainCombatants()
+  dd = combatant1.damageDensityDistribution(combatant2)
+  expected = sum([ p*damageDensity.expected() for damageDensity, p in dd.items() ])
+  assert abs(combatant1.attackDamageDensity(combatant2).expected() - expected) < 1e-12
+  assert abs(combatant1.expectedDamage(combatant2) - expected) < 1e-12
+
+def testQueriesMatchSeparateEvaluation():
+  combatant1, combatant2 = smallCombatants()
+  d = Combatant.combatDistribution(combatant1, combatant2, 3, chanceDefenderStarts=0.5)
+  hp = lambda attacker, defender: attacker.hp
+  wins = lambda attacker, defender: defender.cantFight()
+  results = Combatant.queryDistribution(d, { "hp": DensityQuery(hp), "wins": EventQuery(wins) })
+  assert results["hp"].densities == Combatant.resultDensity(d, hp).densities
+  assert results["wins"] == Combatant.eventProbability(d, wins)
+  results = Combatant.combatQueries(combatant1, combatant2, { "hp": DensityQuery(hp) }, 3, chanceDefenderStarts=0.5)
+  assert results["hp"].densities == combatant1.hpDensity(combatant2, 3, chanceDefenderStarts=0.5).densities
+
+def testRoundQueries():
+  combatant1, combatant2 = smallCombatants()
+  seen = []
+  solution = combatant1.solveCombat(combatant2, maxError=0.01, roundQueries={ "wins": EventQuery(lambda attacker, defender: defender.cantFight()) },
+    onRound=lambda rounds, results: seen.append((rounds, results["wins"])))
+  assert [ rounds for rounds, wins in seen ] == list(range(solution.rounds + 1))
+  assert abs(seen[-1][1] - solution.winMass) < 1e-12
+
+def testCombatSolutionSaveLoad(tmp_path):
+  combatant1, combatant2 = smallCombatants()
+  filename = str(tmp_path / "solution.json")
+  solution = combatant1.solveCombat(combatant2, chanceDefenderStarts=0.5, maxError=0.05)
+  solution.save(filename)
+  loaded = CombatSolution.load(filename, combatant1, combatant2)
+  assert loaded.winProbability(includeError=True) == solution.winProbability(includeError=True)
+  assert loaded.distribution() == solution.distribution()
+  # refining the loaded solution gives the same result as solving directly
+  expected = combatant1.winProbability(combatant2, chanceDefenderStarts=0.5, maxError=0.0001, includeError=True)
+  refined = loaded.refine(0.0001).winProbability(includeError=True)
+  assert all([ abs(a - b) < 1e-12 for a, b in zip(refined, expected) ])
+  other = combatant2.clone()
+  other.hp += 1
+  with pytest.raises(ValueError):
+    CombatSolution.load(filename, combatant1, other)
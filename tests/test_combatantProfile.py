@@ -0,0 +1,52 @@
+from combatantProfile import *
+from collections import Counter
+import pytest
+
+
+def profiles(cache):
+  fighter = CombatantProfile(hp=8, attackDie=d20, bonusToHit=2, damageDie=d6, bonusToDamage=1, evade=12, cache=cache)
+  goblin = CombatantProfile(hp=6, attackDie=d20, bonusToHit=1, damageDie=d4, bonusToDamage=1, evade=11, cache=cache)
+  return (fighter, goblin)
+
+def testResultsMatchCombatant():
+  fighter, goblin = profiles(ArtifactCache())
+  assert fighter.winProbability(goblin) == fighter.combatant().winProbability(goblin.combatant())
+  assert fighter.expectedDamage(goblin) == fighter.combatant().expectedDamage(goblin.combatant())
+
+def storedKinds(cache):
+  return Counter([ key[0] for key in cache.artifacts ])
+
+def testChangedFieldsReuseResults():
+  cache = ArtifactCache()
+  fighter, goblin = profiles(cache)
+  fighter.winProbability(goblin)
+  kinds = storedKinds(cache)
+  # the damage densities don't depend on the hp, so they're reused (as are the transitions of the states reached before)
+  stronger = fighter.replace(hp=10)
+  hits = cache.hits
+  p = stronger.winProbability(goblin)
+  assert storedKinds(cache)["damageDensityDistribution"] == kinds["damageDensityDistribution"]
+  assert storedKinds(cache)["winProbability"] == kinds["winProbability"] + 1
+  assert cache.hits > hits
+  assert p == pytest.approx(stronger.combatant().winProbability(goblin.combatant()))
+  hits = cache.hits
+  assert fighter.replace(hp=10).winProbability(goblin) == p
+  assert cache.hits == hits + 1
+  # a changed evade changes the damage densities of the goblin
+  fighter.replace(evade=14).winProbability(goblin)
+  assert storedKinds(cache)["damageDensityDistribution"] == kinds["damageDensityDistribution"] + 1
+
+def testProfilesAreImmutable():
+  fighter, goblin = profiles(ArtifactCache())
+  with pytest.raises(AttributeError):
+    fighter.hp = 10
+  combatant = fighter.combatant()
+  combatant.hp = 1
+  assert fighter.hp == 8 and fighter.combatant().hp == 8
+
+def testCacheSize():
+  cache = ArtifactCache(maxSize=2)
+  for i in range(5):
+    assert cache.get(i, lambda: i*i) == i*i
+  assert len(cache) == 2 and cache.misses == 5
+  assert cache.get(4, lambda: None) == 16 and cache.hits == 1
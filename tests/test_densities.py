@@ -0,0 +1,141 @@
+from densities import *
+import densities
+import os
+import subprocess
+import sys
+import time
+from fractions import Fraction
+import pytest
+
+
+def testBudgetRaises():
+  with pytest.raises(BudgetExceededError) as info:
+    DieExpr("m1000d100 * m1000d100", budget=Budget(maxSupport=10**5))
+  assert info.value.estimate.support > 10**5
+  assert DieExpr("m2d6", budget=Budget(maxSupport=100)).densities == DieExpr("m2d6").densities
+
+def testBudgetSamplesUntilDeadline():
+  start = time.perf_counter()
+  estimate = DieExpr("m1000d100 * m1000d100", budget=Budget(deadline=1.0), onBudgetExceeded="sample")
+  elapsed = time.perf_counter() - start
+  # sampling uses (almost) all of the available time instead of stopping after the first batch
+  assert estimate.samples > 10000
+  assert 0.5 <= elapsed <= 1.5
+
+def testEvaluateConcurrentlyMatchesSequential():
+  functions = [ lambda n=n: d20.arithMult(n) + d12 for n in range(10, 30) ] + [ lambda: d20.with_advantage().median() ]*4
+  sequential = [ f() for f in functions ]
+  concurrent = evaluateConcurrently(functions, threads=4)
+  assert [ r.densities if isinstance(r, Density) else r for r in concurrent ] == [ r.densities if isinstance(r, Density) else r for r in sequential ]
+
+def testMaxMinDensityMatchBinOp():
+  pairs = Density({ (1, 2): 0.25, (2, 1): 0.5, (2, 2): 0.25 })
+  words = Density({ "a": 0.5, "b": 0.3, "c": 0.2 })
+  mixed = Density({ 1: 0.5, 2.5: 0.5 })
+  for density in [ d20, d6 + d8, pairs, words, mixed ]:
+    assert maxDensity(density, density, density).densities == pytest.approx(density.binOp(density, max).binOp(density, max).densities)
+    assert minDensity(density, density).densities == pytest.approx(density.binOp(density, min).densities)
+  assert d20.with_advantage().densities == pytest.approx(d20.binOp(d20, max).densities)
+  assert pairs.with_disadvantage().densities == pytest.approx(pairs.binOp(pairs, min).densities)
+  assert set([ type(k) for k in maxDensity(mixed, d6).keys() ]) == set([ int, float ])
+
+def testSortedSlicesMatchMultiOp():
+  mixed = Density({ 1: 0.5, 2.5: 0.25, 4: 0.25 })
+  thirds = Density({ Fraction(1, 3): 0.5, Fraction(2, 3): 0.5 })
+  for dice in [ [ d6, d8, d4 ], [ mixed, d4, mixed ], [ thirds, d4, thirds ] ]:
+    multi = MultiDensity(*dice)
+    assert multi.keep_highest(2).densities == pytest.approx(multi.multiOp(lambda *a: sum(sorted(a)[1:])).densities)
+    # the outcomes keep their types (numpy would turn them all into floats resp. objects)
+    assert sorted([ repr(k) for k in multi.keep_highest(2).keys() ]) == sorted([ repr(k) for k in multi.multiOp(lambda *a: sum(sorted(a)[1:])).keys() ])
+    assert multi.drop_highest().densities == pytest.approx(multi.multiOp(lambda *a: sum(a) - max(a)).densities)
+    assert multi.keep_lowest(2).densities == pytest.approx(multi.multiOp(lambda *a: sum(sorted(a)[:2])).densities)
+    assert multi.drop_lowest(2).densities == pytest.approx(multi.multiOp(lambda *a: max(a)).densities)
+
+def testPlotImages(tmp_path):
+  jobs = [ PlotJob.fromFunction(lambda x: d20.cdf(x), range(0, 21), name="cdf"), PlotJob("pmf", d6.keys(), d6.values()) ]
+  filenames = plot_images(jobs, directory=str(tmp_path), processes=2)
+  assert [ os.path.basename(f) for f in filenames ] == [ "cdf.png", "pmf.png" ]
+  assert all([ os.path.getsize(f) > 0 for f in filenames ])
+
+def testPyplotNotImported():
+  # importing densities must not load pyplot (and with it a GUI backend)
+  code = "import sys, densities; print('matplotlib.pyplot' in sys.modules)"
+  result = subprocess.run([ sys.executable, "-c", code ], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), capture_output=True, text=True)
+  assert result.stdout.strip() == "False"
+
+def testLazyMatchesEager():
+  lazy = (d10.lazy().arithMult(5) + d6) - d4.lazy()*2
+  eager = (d10.arithMult(5) + d6) - d4*2
+  assert lazy.expected() == pytest.approx(eager.expected())
+  assert lazy.variance() == pytest.approx(eager.variance())
+  assert lazy.materialize().densities == pytest.approx(eager.densities)
+  assert (lazy >= 25) == pytest.approx(eager >= 25)
+  assert (d20.lazy() + 7 >= d20 + 5) == pytest.approx(d20 + 7 >= d20 + 5)
+  assert lazy.cdf(20) == pytest.approx(eager.cdf(20))
+  assert DieExpr("m10d10 + d6 >= 60", lazy=True) == pytest.approx(DieExpr("m10d10 + d6 >= 60"))
+
+def testSimplifiedExpressionsMatchLiteral():
+  expressions = [ "d6 + d6 + d6 - 2", "3 + d20 - d4 + 2*d6 - d4", "-(d6 - d8) + 4", "2*d6*3 + d10*d4", "d6*0 + ad20",
+    "m2d6 + d6 + d12 - d6", "ad20 + 5 >= d20 + 2*3", "p4d6s5 + d4 - 1" ]
+  for expr in expressions:
+    simplified = DieExpr(expr)
+    literal = DieExpr(expr, simplify=False)
+    if isinstance(literal, Density):
+      assert simplified.densities == pytest.approx(literal.densities)
+    else:
+      assert simplified == pytest.approx(literal)
+  assert ast.unparse(densities._parse_expr("d6 + 1 + d6 + d6")) == "m3d6 + 1"
+
+def testMixtureMatchesCombine():
+  assert mixture([d4, d6, d8], [0.5, 0.25, 0.25]).densities == pytest.approx(MultiDensity(d4, d6, d8).combine(0.5, 0.25, 0.25).densities)
+  mixed = mixture([Density({ 1: 1.0 }), Density({ 1.5: 1.0 })], [0.5, 0.5])
+  assert [ (type(k), mixed[k]) for k in mixed.keys() ] == [ (int, 0.5), (float, 0.5) ]
+  pairs = mixture([Density({ (1, 2): 1.0 }), Density({ (1, 2): 0.5, (2, 1): 0.5 })], [0.5, 0.5])
+  assert pairs.densities == pytest.approx({ (1, 2): 0.75, (2, 1): 0.25 })
+
+def testSuccessCountMatchesBruteForce():
+  def bruteForce(die, n, threshold, doubleThreshold=None):
+    successes = lambda k: (k >= threshold) + (not doubleThreshold is None and k >= doubleThreshold)
+    return MultiDensity(*[die]*n).multiOp(lambda *rolls: sum([ successes(k) for k in rolls ]))
+  for args in [ (d6, 4, 5), (d10, 5, 8, 10), (d10, 3, 10, 8), (d4, 3, 1), (d4, 3, 5) ]:
+    assert args[0].successCount(*args[1:]).densities == pytest.approx(bruteForce(*args).densities)
+  assert DieExpr("p5d10s8s10").densities == pytest.approx(d10.successCount(5, 8, 10).densities)
+  assert DieExpr("p4d6s5 >= 2") == pytest.approx(d6.successCount(4, 5) >= 2)
+
+def testPlotLargeSupport():
+  d = d100.arithMult(20)
+  lines = d.plot(maxRows=100).splitlines()
+  assert len(lines) <= 100
+  # binned rows sum up the probabilities
+  assert sum([ float(line.split("\t")[1].strip().rstrip("%")) for line in lines ]) == pytest.approx(100.0, abs=0.1)
+  assert len(str(d).splitlines()) <= Density.maxPlotRows + 4
+  assert len(d6.plot(maxRows=100).splitlines()) == 6
+  rows = []
+  class Lines:
+    def write(self, line):
+      rows.append(line)
+  assert get_plot(lambda x: x*x, range(1000), maxRows=10, file=Lines()) is None
+  assert len(rows) == 10 and rows[0].split("\t")[0].strip() == "0..99"
+  assert float(rows[0].split("\t")[1]) == pytest.approx(sum([ x*x for x in range(100) ])/100.0)
+
+def testTailApproximations():
+  lazy = d10.lazy().arithMult(1200) - d20.lazy()*3
+  exact = d10.arithMult(1200) - d20*3
+  mean, variance, k3, k4 = lazy.cumulants()
+  assert mean == pytest.approx(exact.expected()) and variance == pytest.approx(exact.variance())
+  stdev = math.sqrt(variance)
+  for k in [ 0, 1, 3, 5 ]:
+    x = round(mean + k*stdev)
+    p, error = lazy.approximateTail(x, includeError=True)
+    assert error > 0.0
+    # the saddlepoint approximation has a small relative error even far into the tail
+    assert abs(p - (exact >= x)) <= 1e-3*(exact >= x)
+    assert lazy.approximateCdf(x - 1) == pytest.approx(1.0 - p)
+    assert lazy.approximateTail(x, method="edgeworth") == pytest.approx(exact >= x, abs=1e-5)
+  keys, probs = exact._getArrays()
+  assert lazy.approximateQuantile(0.99) == keys[np.searchsorted(np.cumsum(probs), 0.99)]
+  # small supports are calculated exactly
+  small = d6.lazy().arithMult(10)
+  assert small.approximateTail(40, includeError=True) == (d6.arithMult(10) >= 40, 0.0)
+  with pytest.raises(ValueError):
+    lazy.approximateTail(7000, method="normal")
@@ -0,0 +1,52 @@
+from groupCombat import *
+
+
+def fighters():
+  fighter = Combatant(hp=8, attackDie=d20, bonusToHit=2, damageDie=d6, bonusToDamage=1, evade=12)
+  goblin = Combatant(hp=6, attackDie=d20, bonusToHit=1, damageDie=d4, bonusToDamage=1, evade=11)
+  return (fighter, goblin)
+
+def testSingleCombatantsMatchCombatSolution():
+  fighter, goblin = fighters()
+  expected = fighter.winProbability(goblin, maxError=1e-5)
+  assert abs(groupWinProbability([fighter], [goblin], maxError=1e-5) - expected) < 1e-4
+
+def testPruningDuringTurns():
+  fighter, goblin = fighters()
+  exact = GroupCombat([fighter]*2, [goblin]*3, targetRandom, targetRandom).refine(0.001)
+  pruned = GroupCombat([fighter]*2, [goblin]*3, targetRandom, targetRandom, pruneThreshold=1e-4).refine(0.001)
+  p, minP, error = pruned.winProbability(includeError=True)
+  assert pruned.prunedMass > 0.0
+  assert abs(p - exact.winProbability()) <= error + 0.001
+  # intermediate distributions within a turn are pruned as well
+  combat = GroupCombat([fighter]*2, [goblin]*3, targetRandom, targetRandom, pruneThreshold=1e-4).refine(0.001, maxRounds=1)
+  prunedMass = combat.prunedMass
+  d = combat._applySideTurn(combat.frontier, 0)
+  assert combat.prunedMass > prunedMass
+  assert all([ p >= 1e-4 for state, p in d.items() if not combat._sideCantFight(1, state) ])
+
+def testTargetsInCanonicalOrder():
+  fighter, goblin = fighters()
+  weakGoblin = goblin.clone()
+  weakGoblin.hp = 2
+  combat = GroupCombat([fighter], [goblin, weakGoblin])
+  state = next(iter(combat.frontier))
+  assert [ c.hp for c in combat.combatants(1, state) ] == [2, 6]
+
+def testDistributionIsSnapshot():
+  fighter, goblin = fighters()
+  combat = GroupCombat([fighter], [goblin]*2).refine(0.5)
+  d = combat.distribution()
+  before = dict(d)
+  combat.refine(0.01)
+  assert d == before
+  assert abs(sum(combat.distribution().values()) - 1.0) < 1e-9
+
+def testKindsDistinguishDamageDensities():
+  def bonusDamage(bonus):
+    def damageDensity(attacker, defender, attackRoll):
+      return attacker.damageDie + bonus
+    return damageDensity
+  weak = Combatant(hp=8, attackDie=d20, bonusToHit=2, damageDie=d4, bonusToDamage=0, evade=12, damageDensity=bonusDamage(0))
+  strong = Combatant(hp=8, attackDie=d20, bonusToHit=2, damageDie=d4, bonusToDamage=0, evade=12, damageDensity=bonusDamage(5))
+  assert len(GroupCombat([weak, strong], [weak]).kinds[0]) == 2
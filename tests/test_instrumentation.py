@@ -0,0 +1,48 @@
+from instrumentation import *
+from densities import Die
+import json
+
+
+def testMemoizedCallCounts():
+  # the counts include calls of a cache created before enabling the instrumentation
+  d6 = Density({ k: 1.0/6 for k in range(1, 7) })
+  d6.arithMult(3)
+  d8 = Density({ k: 1.0/8 for k in range(1, 9) })
+  calls = [ (d6, 3), (d6, 3), (d6, 4), (d6, 3), (d6, 4), (d8, 2), (d8, 2) ]
+  with instrumented() as stats:
+    for d, n in calls:
+      d.arithMult(n)
+  cacheStats = stats.toDict()["caches"]["Density.arithMult"]
+  assert cacheStats["calls"] == len(calls)
+  assert cacheStats["misses"] == 2
+  assert cacheStats["hits"] == len(calls) - 2
+  assert stats.stats["Density.arithMult"]["calls"] == len(calls)
+
+def testOperationsAndRestore():
+  originalBinOp = Density.binOp
+  with instrumented() as stats:
+    Die(20).arithMult(4) + Die(20).arithMult(4)
+    Die(6).binOp(Die(6), max)
+    Die(6) + 3
+  operations = stats.toDict()["operations"]
+  assert operations["Density._convolve"]["calls"] >= 1
+  assert operations["Density.binOp"]["calls"] >= 1
+  assert operations["Density.shift"]["calls"] >= 1
+  assert operations["Density.binOp"]["inputSupport"][8] >= 1
+  assert Density.binOp is originalBinOp and not instrumentation.enabled
+  calls = operations["Density.binOp"]["calls"]
+  Die(6).binOp(Die(6), max)
+  assert stats.stats["Density.binOp"]["calls"] == calls
+
+def testCombatStatesAndTrace(tmp_path):
+  fighter = Combatant(hp=8, attackDie=Die(20), bonusToHit=2, damageDie=Die(6), bonusToDamage=1, evade=12)
+  goblin = Combatant(hp=6, attackDie=Die(20), bonusToHit=1, damageDie=Die(4), bonusToDamage=1, evade=11)
+  with instrumented(trace=True) as stats:
+    Combatant.combatDistribution(fighter, goblin, 3)
+  assert len(stats.statesPerRound) == 3 and stats.statesPerRound[0][0] == 1
+  filename = str(tmp_path / "trace.json")
+  stats.saveTrace(filename)
+  with open(filename) as f:
+    events = json.load(f)["traceEvents"]
+  assert len([ e for e in events if e["name"] == "Combatant._applyAttackRound" ]) == 3
+  assert "States per round" in stats.report()
@@ -0,0 +1,33 @@
+from sampling import *
+
+
+def cdfDistance(estimate, exact):
+  keys = sorted(set(estimate.keys()) | set(exact.keys()))
+  estimated = list(accumulate([ estimate.densities.get(k, 0.0) for k in keys ]))
+  expected = list(accumulate([ exact.densities.get(k, 0.0) for k in keys ]))
+  return max([ abs(a - b) for a, b in zip(estimated, expected) ])
+
+def testMultiOpWithinCdfBand():
+  estimate = estimateMultiOp([d6, d6, d6], lambda a, b, c: a + b + c, seed=1)
+  exact = MultiDensity(d6, d6, d6).multiOp(lambda a, b, c: a + b + c)
+  assert estimate.maxError() <= 0.005
+  assert cdfDistance(estimate, exact) <= estimate.maxError()
+
+def testWideSupportDrawsEnoughSamples():
+  # every single outcome is unlikely, but the estimate must still be close to the exact distribution
+  estimate = estimateExpression("d1000+d1000", seed=2, precision=0.01)
+  assert estimate.samples >= math.log(2.0/0.05)/(2.0*0.01**2)
+  assert cdfDistance(estimate, DieExpr("d1000+d1000")) <= 0.01
+
+def testVectorizedMatchesExpression():
+  estimate = estimateMultiOp([d20, d20], lambda a, b: np.maximum(a, b), vectorized=True, seed=3)
+  assert cdfDistance(estimate, d20.with_advantage()) <= estimate.maxError()
+
+def testNealWinProbabilityWithProcesses():
+  attacker = Dnd2NealCombatant(hp=20, attackDie=AdvantageDie(20), bonusToHit=9, damageDie=Die(8)+Die(4), bonusToDamage=3, ac=13)
+  defender = Dnd2NealCombatant(hp=20, attackDie=Die(20), bonusToHit=9, damageDie=Die(8), bonusToDamage=3, ac=18)
+  # exact value of attacker.winProbability(defender, chanceDefenderStarts=0.5)
+  exact = 0.6334792877550004
+  p, (low, high) = estimateWinProbability(attacker, defender, chanceDefenderStarts=0.5, includeError=True, processes=2, seed=4, precision=0.01)
+  assert low <= exact <= high
+  assert abs(p - exact) <= 0.02
@@ -0,0 +1,39 @@
+from server import *
+import asyncio
+import pytest
+
+
+def combatRequest(op, **kwargs):
+  fighter = {"hp": 8, "attackDie": "d20", "bonusToHit": 3, "damageDie": "d6", "bonusToDamage": 1, "evade": 12}
+  return dict({"op": op, "attacker": fighter, "defender": dict(fighter, hp = 10)}, **kwargs)
+
+def testCombatMatchesCombatant():
+  attacker = Combatant(hp = 8, attackDie = d20, bonusToHit = 3, damageDie = d6, bonusToDamage = 1, evade = 12)
+  defender = Combatant(hp = 10, attackDie = d20, bonusToHit = 3, damageDie = d6, bonusToDamage = 1, evade = 12)
+  res = evaluate(combatRequest("winProbability", maxError = 0.001), Budget(deadline = 10.0), maxRounds = 1000)
+  assert res["probability"] == pytest.approx(attacker.winProbability(defender, maxError = 0.001))
+  res = evaluate(combatRequest("hpDensity", rounds = 3), Budget(deadline = 10.0), maxRounds = 1000)
+  assert dict(res["density"]) == pytest.approx(attacker.hpDensity(defender, rounds = 3).densities)
+
+def testCombatLimits():
+  with pytest.raises(BudgetExceededError):
+    evaluate(combatRequest("winProbability", maxError = 0.0), maxRounds = 3)
+  with pytest.raises(BudgetExceededError):
+    evaluate(combatRequest("hpDensity", rounds = 10), maxRounds = 3)
+  with pytest.raises(BudgetExceededError):
+    evaluate(combatRequest("winProbability", maxError = 0.0), Budget(deadline = 0.0))
+  res = evaluate(combatRequest("winProbability", maxError = 0.0), onBudgetExceeded = "sample", maxRounds = 3)
+  assert res["error"] > 0.0
+
+def testBudgetExceededIs422():
+  server = EvaluationServer(workers = 0, budget = 1.0, maxRounds = 3)
+  try:
+    status, res = asyncio.run(server._handleRequest("POST", "/", json.dumps(combatRequest("winProbability", maxError = 0.0))))
+    assert status == 422
+    status, res = asyncio.run(server._handleRequest("POST", "/", json.dumps({"op": "dieExpr", "expr": "m1000d100 * m1000d100"})))
+    assert status == 422
+    status, res = asyncio.run(server._handleRequest("POST", "/", json.dumps({"op": "dieExpr", "expr": "m3d6 + 2"})))
+    assert status == 200 and res["expected"] == pytest.approx(12.5)
+    assert server.stats["budgetExceeded"] == 2
+  finally:
+    server.close()
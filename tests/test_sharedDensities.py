@@ -0,0 +1,44 @@
+from sharedDensities import *
+from concurrent.futures import ProcessPoolExecutor
+import pickle
+import pytest
+
+
+def attachedProbability(handle):
+  return handle.attach() >= 2600
+
+def testPublishAttach(tmp_path):
+  d = d100.arithMult(50)
+  for directory in [ None, str(tmp_path) ]:
+    with SharedDensityStore(directory) as store:
+      attached = pickle.loads(pickle.dumps(store.publish(d))).attach()
+      assert attached.keys() == d.keys() and attached.values() == d.values()
+      assert attached[2600] == d[2600] and (attached >= 2600) == (d >= 2600)
+      assert pickle.loads(pickle.dumps(attached)).densities == d.densities
+    if not directory is None:
+      assert os.listdir(directory) == []
+
+def testAttachInWorkers():
+  d = d100.arithMult(50)
+  with SharedDensityStore() as store:
+    handle = store.publish(d)
+    with ProcessPoolExecutor(2) as executor:
+      assert list(executor.map(attachedProbability, [handle]*2)) == [d >= 2600]*2
+  floats = Density({ 0.5: 0.25, 1.5: 0.75 })
+  with SharedDensityStore() as store:
+    assert store.publish(floats).attach().densities == floats.densities
+    with pytest.raises(ValueError):
+      store.publish(Density({ (1, 2): 1.0 }))
+
+def testInstallDamageDistribution():
+  cache = ArtifactCache()
+  fighter = CombatantProfile(hp=8, attackDie=d20, bonusToHit=2, damageDie=d6, bonusToDamage=1, evade=12, cache=cache)
+  goblin = CombatantProfile(hp=6, attackDie=d20, bonusToHit=1, damageDie=d4, bonusToDamage=1, evade=11, cache=cache)
+  expected = fighter.combatant().damageDensityDistribution(goblin.combatant())
+  with SharedDensityStore() as store:
+    handle = store.publishDamageDistribution(fighter, goblin)
+    cache.clear()
+    distribution = handle.install(cache)
+    assert fighter.damageDensityDistribution(goblin) is distribution
+    assert cache.hits == 1 and cache.misses == 0
+    assert sorted([ (d._state(), p) for d, p in distribution.items() ]) == sorted([ (d._state(), p) for d, p in expected.items() ])